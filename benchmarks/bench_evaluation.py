@@ -0,0 +1,72 @@
+"""Users per second of the user evaluation, per user and batched.
+
+`evaluate_users` with `batch_size=1` evaluates one user at a time with
+`online_evaluate`; larger batch sizes run `evaluate_batch`, which steps
+the environments of a batch of users in lockstep with one state, actor
+and scoring pass per step. Both DRR and FairRec agents are timed on the
+same users of a synthetic dataset.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_evaluation
+    python -m benchmarks.bench_evaluation --users 1000 --batch-sizes 1 64 256
+"""
+
+import argparse
+import time
+
+from benchmarks.synthetic import SyntheticDataset
+
+
+def users_per_second(agent, users, make_env, batch_size, top_k):
+    agent.evaluate_users(users[:batch_size], make_env, top_k, batch_size=batch_size)
+
+    start = time.perf_counter()
+    agent.evaluate_users(users, make_env, top_k, batch_size=batch_size)
+    return len(users) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--items", type=int, default=1500)
+    parser.add_argument("--eval-users", type=int, default=256)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32, 128])
+    parser.add_argument("--top-k", type=int, default=0)
+    parser.add_argument("--done-count", type=int, default=10)
+    args = parser.parse_args()
+
+    dataset = SyntheticDataset(args.users, args.items)
+    top_k = args.top_k or False
+
+    print("{:>10} {:>6} {:>12} {:>8}".format("agent", "batch", "users/s", "speedup"))
+    for fair in (False, True):
+        env = dataset.make_env(fair, args.done_count)
+        # eval only: no learner step is ever taken
+        agent = dataset.make_agent(env, fair, learning_starts=10**9)
+        users = list(env.available_users)[: args.eval_users]
+
+        def make_env(user_id):
+            kwargs = dict(
+                fix_user_id=user_id,
+                reward_model=agent.reward_model,
+                histories=env.histories,
+                group_index=env.group_index,
+            )
+            if fair:
+                kwargs["item_features"] = env.item_features
+            return dataset.make_env(fair, args.done_count, **kwargs)
+
+        baseline = None
+        for batch_size in args.batch_sizes:
+            rate = users_per_second(agent, users, make_env, batch_size, top_k)
+            baseline = baseline or rate
+            print(
+                "{:>10} {:>6} {:>12.0f} {:>7.1f}x".format(
+                    "FairRec" if fair else "DRR", batch_size, rate, rate / baseline
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Updates per second and memory of DRRAgent.update_model, before and after
+the fused learner step.
+
+The "before" step is the original update: the value loss backpropagates
+through the TD targets, and the actor and the critic are updated by two
+backward passes with retained graphs. The fused step computes the targets
+under no_grad and takes a single backward pass. Both runs start from the
+same seed, weights and replay buffer, and sample the same batches.
+
+Peak memory is `torch.cuda.max_memory_allocated` on CUDA. On the CPU,
+where tracemalloc does not see the tensor allocator, it is the size of the
+tensors saved for the backward pass.
+
+Loss parity is asserted on every update against the original step with
+detached TD targets (the one intended change of the fused step), and on
+the first update against the original step as is.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_learner_step
+    python -m benchmarks.bench_learner_step --updates 500 --batch-size 256
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.synthetic import SyntheticDataset
+
+
+def legacy_update_model(agent, detach_targets=False):
+    """`update_model` before the fused learner step."""
+
+    (
+        batch_states,
+        batch_actions,
+        batch_rewards,
+        batch_next_states,
+        batch_dones,
+        weight_batch,
+        index_batch,
+    ) = agent.sample_batch()
+
+    states = agent.get_state(
+        batch_states[:, 0].long(),
+        batch_states[:, 1 : agent.state_size + 1].long(),
+        batch_states[:, agent.state_size + 1 :].long(),
+    )
+    actions = agent.actor.network(states)
+    policy_loss = -agent.critic.network([actions, states]).mean()
+
+    next_states = agent.get_state(
+        batch_next_states[:, 0].long(),
+        batch_next_states[:, 1 : agent.state_size + 1].long(),
+        batch_next_states[:, agent.state_size + 1 :].long(),
+    )
+    target_next_action = agent.actor.target_network(next_states)
+    target_qs = agent.critic.target_network([target_next_action.detach(), next_states])
+    qs = agent.critic.network([target_next_action.detach(), next_states])
+    min_qs = torch.min(torch.cat([target_qs, qs], axis=1), 1, True).values.squeeze(1)
+
+    td_targets = agent.calculate_td_target(batch_rewards, min_qs, batch_dones)
+    td_targets = td_targets.unsqueeze(1)
+    if detach_targets:
+        td_targets = td_targets.detach()
+
+    priorities = (
+        (td_targets.detach().abs().squeeze(1) + agent.epsilon_for_priority)
+        .cpu()
+        .numpy()
+    )
+    agent.buffer.update_priorities(priorities, index_batch)
+
+    value = agent.critic.network([batch_actions, states])
+    value_loss = torch.mean(agent.critic.loss(value, td_targets) * weight_batch)
+
+    agent.srm.optimizer.zero_grad()
+    agent.actor.optimizer.zero_grad()
+    policy_loss.backward(retain_graph=True)
+    agent.actor.optimizer.step()
+
+    agent.critic.optimizer.zero_grad()
+    value_loss.backward(retain_graph=True)
+    agent.critic.optimizer.step()
+    agent.srm.optimizer.step()
+
+    agent.actor.update_target_network()
+    agent.critic.update_target_network()
+
+    return value_loss.detach(), policy_loss.detach()
+
+
+def make_agent(dataset, batch_size, seed, n_transitions=5000):
+    """Agent with a replay buffer of random transitions, seeded so two
+    agents hold the same weights and draw the same batches."""
+
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    agent = dataset.make_agent(None, learning_starts=0, batch_size=batch_size)
+
+    rng = np.random.default_rng(seed)
+    state_size, n_groups = dataset.state_size, dataset.n_groups
+    for step in range(n_transitions):
+        agent.buffer.append_step(
+            rng.integers(dataset.users_num),
+            rng.integers(0, dataset.items_num, state_size),
+            rng.integers(0, 3, n_groups),
+            rng.normal(size=agent.embedding_dim),
+            rng.uniform(-1, 1),
+            rng.integers(0, dataset.items_num, state_size),
+            rng.integers(0, 3, n_groups),
+            step % 10 == 9,
+        )
+    agent.buffer.flush()
+    np.random.seed(seed)
+    return agent
+
+
+def saved_tensors_bytes(update):
+    """Bytes of the tensors saved for the backward pass during `update`."""
+
+    sizes = []
+
+    def pack(tensor):
+        sizes.append(tensor.untyped_storage().nbytes())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        update()
+    return sum(sizes)
+
+
+def run(dataset, update, batch_size, updates, seed):
+    agent = make_agent(dataset, batch_size, seed)
+    step = (lambda: update(agent)) if update else agent.update_model
+
+    step()  # warm up
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        step()
+        memory = torch.cuda.max_memory_allocated() - base
+    else:
+        memory = saved_tensors_bytes(step)
+
+    start = time.perf_counter()
+    for _ in range(updates):
+        step()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return updates / (time.perf_counter() - start), memory
+
+
+def losses(dataset, update, batch_size, updates, seed):
+    agent = make_agent(dataset, batch_size, seed)
+    step = (lambda: update(agent)) if update else agent.update_model
+    return np.array([[float(loss) for loss in step()] for _ in range(updates)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--items", type=int, default=1500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--parity-updates", type=int, default=20)
+    args = parser.parse_args()
+
+    dataset = SyntheticDataset(args.users, args.items)
+
+    # loss parity at a fixed seed
+    fused = losses(dataset, None, args.batch_size, args.parity_updates, args.seed)
+    detached = losses(
+        dataset,
+        lambda agent: legacy_update_model(agent, detach_targets=True),
+        args.batch_size,
+        args.parity_updates,
+        args.seed,
+    )
+    original = losses(dataset, legacy_update_model, args.batch_size, 1, args.seed)
+    np.testing.assert_allclose(fused, detached, rtol=1e-4, atol=1e-6)
+    np.testing.assert_array_equal(fused[:1], original)
+    print(
+        "losses match over {} updates (max abs diff {:.2e})".format(
+            args.parity_updates, np.abs(fused - detached).max()
+        )
+    )
+
+    memory_unit = "MB" if torch.cuda.is_available() else "MB saved"
+    print("{:>8} {:>12} {:>12}".format("step", "updates/s", "peak " + memory_unit))
+    for name, update in (("before", legacy_update_model), ("after", None)):
+        rate, memory = run(dataset, update, args.batch_size, args.updates, args.seed)
+        print("{:>8} {:>12.1f} {:>12.2f}".format(name, rate, memory / 2**20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Microbenchmark of the prioritized replay sampler.
+
+Compares the original sampler (one `random.uniform` draw and one walk of
+the original array-heap SumTree per segment, in a Python loop) with the
+batched stratified sampler of `PriorityExperienceReplay.sample`, across
+buffer and batch sizes. Both samplers read the same priorities.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_sampling
+    python -m benchmarks.bench_sampling --buffer-sizes 10000 1000000 --batch-sizes 64
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+
+from src.model.replay_buffer import PriorityExperienceReplay
+
+
+class LegacySumTree(object):
+    """The original array-heap sum tree (root at index 0, leaves after the
+    `buffer_size - 1` internal nodes), searched one value at a time."""
+
+    def __init__(self, priorities, reduce=np.add):
+        self.buffer_size = len(priorities)
+        self.tree = np.zeros(self.buffer_size * 2 - 1)
+        self.tree[self.buffer_size - 1 :] = priorities
+        # internal nodes, bottom-up one heap level at a time
+        n_internal = self.buffer_size - 1
+        for depth in reversed(range(max(0, n_internal.bit_length()))):
+            nodes = np.arange((1 << depth) - 1, min((2 << depth) - 1, n_internal))
+            self.tree[nodes] = reduce(
+                self.tree[nodes * 2 + 1], self.tree[nodes * 2 + 2]
+            )
+
+    def search(self, num):
+        current = 0
+        while True:
+            left = (current * 2) + 1
+            right = (current * 2) + 2
+
+            if num <= self.tree[left]:
+                current = left
+            else:
+                num -= self.tree[left]
+                current = right
+
+            if current >= self.buffer_size - 1:
+                break
+
+        return self.tree[current], current, current - self.buffer_size + 1
+
+    def sum_all_priority(self):
+        return float(self.tree[0])
+
+    def min_priority(self):
+        return float(self.tree[0])
+
+
+def legacy_sample(buffer, sum_tree, min_tree, batch_size):
+    """The sampler before the batched one: a Python loop over the segments,
+    each walking the original sum tree from the root."""
+
+    rd_idx = []
+    weight_batch = []
+    index_batch = []
+    sum_priority = sum_tree.sum_all_priority()
+
+    N = len(buffer)
+    min_priority = min_tree.min_priority() / sum_priority
+    max_weight = (N * min_priority) ** (-buffer.beta)
+
+    segment_size = sum_priority / batch_size
+    for j in range(batch_size):
+        min_seg = segment_size * j
+        max_seg = segment_size * (j + 1)
+
+        random_num = random.uniform(min_seg, max_seg)
+        priority, tree_index, buffer_index = sum_tree.search(random_num)
+        rd_idx.append(buffer_index)
+
+        p_j = priority / sum_priority
+        w_j = (p_j * N) ** (-buffer.beta) / max_weight
+        weight_batch.append(w_j)
+        index_batch.append(tree_index)
+    buffer.beta = min(1.0, buffer.beta + buffer.beta_constant)
+
+    return (
+        buffer.states[rd_idx],
+        buffer.actions[rd_idx],
+        buffer.rewards[rd_idx],
+        buffer.next_states[rd_idx],
+        buffer.dones[rd_idx],
+        torch.FloatTensor(weight_batch).to(buffer.device),
+        index_batch,
+    )
+
+
+def make_buffers(buffer_size, embedding_dim, obs_size, device):
+    """A full buffer with random priorities, and the original trees holding
+    the same priorities."""
+
+    buffer = PriorityExperienceReplay(buffer_size, embedding_dim, obs_size, device)
+    priorities = np.random.uniform(0.01, 1.0, buffer_size)
+    buffer.tree.update_priorities(priorities, np.arange(buffer_size))
+    buffer.crt_idx = 0
+    buffer.is_full = True
+    return buffer, LegacySumTree(priorities), LegacySumTree(priorities, np.minimum)
+
+
+def timeit(fn, repeat):
+    fn()  # warm up (numba compilation, allocator)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--buffer-sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32, 128, 512])
+    parser.add_argument("--embedding-dim", type=int, default=16)
+    parser.add_argument("--obs-size", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    print(
+        "{:>12} {:>6} {:>12} {:>12} {:>8}".format(
+            "buffer", "batch", "legacy (us)", "batched (us)", "speedup"
+        )
+    )
+    for buffer_size in args.buffer_sizes:
+        buffer, sum_tree, min_tree = make_buffers(
+            buffer_size, args.embedding_dim, args.obs_size, args.device
+        )
+        for batch_size in args.batch_sizes:
+            legacy = timeit(
+                lambda: legacy_sample(buffer, sum_tree, min_tree, batch_size),
+                args.repeat,
+            )
+            batched = timeit(lambda: buffer.sample(batch_size), args.repeat)
+            print(
+                "{:>12} {:>6} {:>12.1f} {:>12.1f} {:>7.1f}x".format(
+                    buffer_size,
+                    batch_size,
+                    legacy * 1e6,
+                    batched * 1e6,
+                    legacy / batched,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
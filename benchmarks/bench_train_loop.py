@@ -0,0 +1,89 @@
+"""Steps per second of DRRAgent.train, before and after the staged append.
+
+The train loop stores each transition with `buffer.append_step`, which
+writes raw values into preallocated staging rows. The "before" run
+replaces it with the original path, which built five tensors per step and
+called `buffer.append`, so both runs share the rest of the loop. Each
+configuration is timed with learning disabled (collection only) and
+enabled (one learner step per environment step).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_train_loop
+    python -m benchmarks.bench_train_loop --episodes 200 --batch-size 128
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.synthetic import SyntheticDataset
+
+
+def legacy_append_step(buffer, device):
+    """`append_step` through the original per-step tensor path."""
+
+    def append_step(
+        user_id,
+        items_ids,
+        group_counts,
+        action,
+        reward,
+        next_items_ids,
+        next_group_counts,
+        done,
+    ):
+        buffer.append(
+            torch.Tensor(np.concatenate(([user_id], items_ids, group_counts))).to(
+                device
+            ),
+            torch.Tensor(np.asarray(action)).to(device),
+            torch.FloatTensor([reward]).to(device),
+            torch.Tensor(
+                np.concatenate(([user_id], next_items_ids, next_group_counts))
+            ).to(device),
+            torch.Tensor([done]).to(device),
+        )
+
+    return append_step
+
+
+def run(dataset, episodes, learn, legacy, batch_size):
+    env = dataset.make_env()
+    agent = dataset.make_agent(
+        env, learning_starts=0 if learn else 10**9, batch_size=batch_size
+    )
+    if legacy:
+        agent.buffer.append_step = legacy_append_step(agent.buffer, agent.device)
+
+    agent.train(2)  # warm up
+    steps = len(agent.buffer)
+    start = time.perf_counter()
+    agent.train(episodes)
+    return (len(agent.buffer) - steps) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--episodes", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--items", type=int, default=1500)
+    args = parser.parse_args()
+
+    dataset = SyntheticDataset(args.users, args.items)
+    print("{:>10} {:>14} {:>14} {:>8}".format("learning", "before", "after", "speedup"))
+    for learn in (False, True):
+        before = run(dataset, args.episodes, learn, True, args.batch_size)
+        after = run(dataset, args.episodes, learn, False, args.batch_size)
+        print(
+            "{:>10} {:>10.0f} st/s {:>10.0f} st/s {:>7.2f}x".format(
+                "on" if learn else "off", before, after, after / before
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
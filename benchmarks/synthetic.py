@@ -0,0 +1,133 @@
+"""Synthetic dataset and agents shared by the benchmarks.
+
+The dataset stage needs the MovieLens downloads, so the benchmarks build
+a random feedback log of the same shape instead, with a small BPMF reward
+model and random PMF embeddings saved to a temporary directory.
+"""
+
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+import torch
+
+from src.environment import OfflineEnv, OfflineFairEnv
+from src.model.bpmf import BPMF
+from src.model.pmf import PMF
+from src.model.recommender import DRRAgent, FairRecAgent
+
+
+EMBEDDING_DIM = 100
+
+
+class SyntheticDataset(object):
+    """Random ratings of `users_num` users over `items_num` items.
+
+    Parameters
+    ----------
+    users_num: int
+        Number of users.
+    items_num: int
+        Number of items.
+    n_groups: int
+        Number of item groups.
+    state_size: int
+        State size of the environments.
+    seed: int
+        Seed of the ratings and models.
+    """
+
+    def __init__(
+        self, users_num=300, items_num=1500, n_groups=4, state_size=10, seed=0
+    ):
+        self.users_num = users_num
+        self.items_num = items_num
+        self.n_groups = n_groups
+        self.state_size = state_size
+
+        rng = np.random.default_rng(seed)
+        self.users_dict = {}
+        ratings = []
+        for user in range(users_num):
+            n = int(rng.integers(2 * state_size, 12 * state_size))
+            items = rng.choice(items_num, n, replace=False)
+            rates = rng.integers(1, 6, n)
+            self.users_dict[user] = list(zip(items.tolist(), rates.tolist()))
+            ratings.append(np.column_stack((np.full(n, user), items, rates)))
+        self.item_groups = {
+            item: int(group)
+            for item, group in enumerate(rng.integers(1, n_groups + 1, items_num))
+        }
+
+        self.path = tempfile.mkdtemp(prefix="drl-recsys-bench-")
+        self.model_path = os.path.join(self.path, "model")
+        os.makedirs(self.model_path)
+
+        self.embedding_path = os.path.join(self.path, "pmf.pt")
+        torch.manual_seed(seed)
+        torch.save(
+            PMF(users_num, items_num, EMBEDDING_DIM).state_dict(), self.embedding_path
+        )
+
+        self.reward_model_path = os.path.join(self.path, "bpmf.pkl")
+        reward_model = BPMF(
+            users_num, items_num, 10, seed=seed, max_rating=5, min_rating=1
+        )
+        reward_model.fit(np.concatenate(ratings).astype(float), n_iters=3)
+        with open(self.reward_model_path, "wb") as f:
+            pickle.dump(reward_model, f)
+
+    def env_kwargs(self, fair=False, done_count=10):
+        kwargs = dict(
+            users_dict=self.users_dict,
+            n_groups=self.n_groups,
+            item_groups=self.item_groups,
+            state_size=self.state_size,
+            done_count=done_count,
+            reward_threshold=4,
+            use_only_reward_model=True,
+        )
+        if fair:
+            items_metadata = pd.DataFrame(
+                {
+                    "item_id": np.arange(self.items_num),
+                    "metadata": ["[]"] * self.items_num,
+                }
+            )
+            kwargs.update(
+                items_metadata=items_metadata,
+                items_df=items_metadata,
+                fairness_constraints=[1 / self.n_groups] * self.n_groups,
+                reward_version="combining",
+                user_intent="item_emb_pmf",
+                user_intent_threshold=0.5,
+            )
+        return kwargs
+
+    def make_env(self, fair=False, done_count=10, **kwargs):
+        env = OfflineFairEnv if fair else OfflineEnv
+        return env(**self.env_kwargs(fair, done_count), **kwargs)
+
+    def make_agent(self, env, fair=False, **kwargs):
+        args = dict(
+            env=env,
+            users_num=self.users_num,
+            items_num=self.items_num,
+            state_size=self.state_size,
+            srm_size=2 if fair else 3,
+            srm_type="fairrec_paper" if fair else "drr_paper",
+            model_path=self.model_path,
+            reward_model_path=self.reward_model_path,
+            embedding_network_weights_path=self.embedding_path,
+            train_version="benchmark",
+            n_groups=self.n_groups,
+            fairness_constraints=[1 / self.n_groups] * self.n_groups,
+            embedding_dim=EMBEDDING_DIM,
+            replay_memory_size=100000,
+            batch_size=64,
+            no_cuda=not torch.cuda.is_available(),
+        )
+        args.update(kwargs)
+        return (FairRecAgent if fair else DRRAgent)(**args)
@@ -10,11 +10,16 @@ from math import ceil
 
 from ..utils import DownloadDataset
 from ..utils import split_train_test
+from ..utils import group_ratings_by_user, count_positive_ratings
+from ..histories import compile_user_histories
+from ..item_features import ItemFeatureStore
 
 
 class ML100kLoadAndPrepareDataset(luigi.Task):
     output_path: str = luigi.Parameter(default=os.path.join(os.getcwd(), "data/"))
     n_groups: int = luigi.IntParameter(default=4)
+    state_size: int = luigi.IntParameter(default=10)
+    reward_thresholds: list = luigi.ListParameter(default=[4.0])
 
     def __init__(self, *args, **kwargs):
         super(ML100kLoadAndPrepareDataset, self).__init__(*args, **kwargs)
@@ -33,6 +38,12 @@ class ML100kLoadAndPrepareDataset(luigi.Task):
             "title_emb": luigi.LocalTarget(
                 os.path.join(self.data_dir, "title_emb.csv")
             ),
+            "metadata_features": luigi.LocalTarget(
+                os.path.join(self.data_dir, "metadata_features.npy")
+            ),
+            "title_features": luigi.LocalTarget(
+                os.path.join(self.data_dir, "title_features.npy")
+            ),
             "users_df": luigi.LocalTarget(os.path.join(self.data_dir, "users.csv")),
             "ratings_df": luigi.LocalTarget(os.path.join(self.data_dir, "ratings.csv")),
             "train_users_dict": luigi.LocalTarget(
@@ -41,6 +52,12 @@ class ML100kLoadAndPrepareDataset(luigi.Task):
             "eval_users_dict": luigi.LocalTarget(
                 os.path.join(self.data_dir, "eval_users_dict.pkl")
             ),
+            "train_histories": luigi.LocalTarget(
+                os.path.join(self.data_dir, "train_histories.npz")
+            ),
+            "eval_histories": luigi.LocalTarget(
+                os.path.join(self.data_dir, "eval_histories.npz")
+            ),
             "train_users_df": luigi.LocalTarget(
                 os.path.join(self.data_dir, "train_users_df.csv")
             ),
@@ -156,31 +173,23 @@ class ML100kLoadAndPrepareDataset(luigi.Task):
                 index=False,
             )
 
+        # dense item features of the environments, see ItemFeatureStore
+        item_features = ItemFeatureStore.from_frames(
+            datasets["items_metadata"], datasets["title_emb"]
+        )
+        item_features.save("metadata", self.output()["metadata_features"].path)
+        item_features.save("title", self.output()["title_features"].path)
+
         return datasets
 
     def prepareDataset(self, datasets):
 
         datasets["ratings"] = datasets["ratings"].sort_values("timestamp")
-        datasets["ratings"] = datasets["ratings"].applymap(int)
+        datasets["ratings"] = datasets["ratings"].astype(int)
 
-        users_dict = {user: [] for user in set(datasets["ratings"]["user_id"])}
-
-        ratings_df_gen = datasets["ratings"].iterrows()
-        users_dict_positive_items = {
-            user: [] for user in set(datasets["ratings"]["user_id"])
-        }
-        for data in ratings_df_gen:
-            users_dict[data[1]["user_id"]].append(
-                (data[1]["item_id"], data[1]["rating"])
-            )
-            if data[1]["rating"] >= 4:
-                users_dict_positive_items[data[1]["user_id"]].append(
-                    (data[1]["item_id"], data[1]["rating"])
-                )
-        users_history_lens = [
-            len(users_dict_positive_items[u])
-            for u in set(datasets["ratings"]["user_id"])
-        ]
+        users_history_lens = count_positive_ratings(
+            datasets["ratings"], np.unique(datasets["ratings"]["user_id"])
+        )
 
         users_num = max(datasets["ratings"]["user_id"]) + 1
         items_num = max(datasets["ratings"]["item_id"]) + 1
@@ -199,20 +208,10 @@ class ML100kLoadAndPrepareDataset(luigi.Task):
         print(train_df.shape, test_df.shape)
 
         # Training setting
-        train_users_dict = {user: [] for user in set(train_df["user_id"])}
-        ratings_df_gen = train_df.iterrows()
-        for data in ratings_df_gen:
-            train_users_dict[data[1]["user_id"]].append(
-                (data[1]["item_id"], data[1]["rating"])
-            )
+        train_users_dict = group_ratings_by_user(train_df)
 
         # Evaluating setting
-        eval_users_dict = {user: [] for user in set(test_df["user_id"])}
-        ratings_df_gen = test_df.iterrows()
-        for data in ratings_df_gen:
-            eval_users_dict[data[1]["user_id"]].append(
-                (data[1]["item_id"], data[1]["rating"])
-            )
+        eval_users_dict = group_ratings_by_user(test_df)
 
         # Save processed data
         with open(self.output()["train_users_dict"].path, "wb") as file:
@@ -221,6 +220,18 @@ class ML100kLoadAndPrepareDataset(luigi.Task):
         with open(self.output()["eval_users_dict"].path, "wb") as file:
             pickle.dump(eval_users_dict, file)
 
+        # positive items of each user, loaded by the environments
+        for split, users_dict in (
+            ("train_histories", train_users_dict),
+            ("eval_histories", eval_users_dict),
+        ):
+            np.savez(
+                self.output()[split].path,
+                **compile_user_histories(
+                    users_dict, self.state_size, self.reward_thresholds
+                ),
+            )
+
         with open(self.output()["users_history_lens"].path, "wb") as file:
             pickle.dump(users_history_lens, file)
 
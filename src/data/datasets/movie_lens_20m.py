@@ -10,11 +10,16 @@ from sentence_transformers import SentenceTransformer
 
 from ..utils import DownloadDataset
 from ..utils import split_train_test
+from ..utils import group_ratings_by_user, count_positive_ratings
+from ..histories import compile_user_histories
+from ..item_features import ItemFeatureStore
 
 
 class ML20MLoadAndPrepareDataset(luigi.Task):
     output_path: str = luigi.Parameter(default=os.path.join(os.getcwd(), "data/"))
     n_groups: int = luigi.IntParameter(default=4)
+    state_size: int = luigi.IntParameter(default=10)
+    reward_thresholds: list = luigi.ListParameter(default=[4.0])
 
     def __init__(self, *args, **kwargs):
         super(ML20MLoadAndPrepareDataset, self).__init__(*args, **kwargs)
@@ -33,6 +38,12 @@ class ML20MLoadAndPrepareDataset(luigi.Task):
             "title_emb": luigi.LocalTarget(
                 os.path.join(self.data_dir, "title_emb.csv")
             ),
+            "metadata_features": luigi.LocalTarget(
+                os.path.join(self.data_dir, "metadata_features.npy")
+            ),
+            "title_features": luigi.LocalTarget(
+                os.path.join(self.data_dir, "title_features.npy")
+            ),
             "ratings_df": luigi.LocalTarget(os.path.join(self.data_dir, "ratings.csv")),
             "train_users_dict": luigi.LocalTarget(
                 os.path.join(self.data_dir, "train_users_dict.pkl")
@@ -40,6 +51,12 @@ class ML20MLoadAndPrepareDataset(luigi.Task):
             "eval_users_dict": luigi.LocalTarget(
                 os.path.join(self.data_dir, "eval_users_dict.pkl")
             ),
+            "train_histories": luigi.LocalTarget(
+                os.path.join(self.data_dir, "train_histories.npz")
+            ),
+            "eval_histories": luigi.LocalTarget(
+                os.path.join(self.data_dir, "eval_histories.npz")
+            ),
             # "train_users_df": luigi.LocalTarget(
             #     os.path.join(self.data_dir, "train_users_df.csv")
             # ),
@@ -128,31 +145,24 @@ class ML20MLoadAndPrepareDataset(luigi.Task):
                 index=False,
             )
 
+        # dense item features of the environments, see ItemFeatureStore
+        item_features = ItemFeatureStore.from_frames(
+            datasets["items_metadata"], datasets["title_emb"]
+        )
+        item_features.save("metadata", self.output()["metadata_features"].path)
+        item_features.save("title", self.output()["title_features"].path)
+
         return datasets
 
     def prepareDataset(self, datasets):
 
         datasets["ratings"] = datasets["ratings"].sort_values("timestamp")
-        datasets["ratings"] = datasets["ratings"].applymap(int)
-
-        users_dict = {user: [] for user in set(datasets["ratings"]["user_id"])}
+        datasets["ratings"] = datasets["ratings"].astype(int)
 
-        ratings_df_gen = datasets["ratings"].iterrows()
-        users_dict_for_history_len = {
-            user: [] for user in set(datasets["ratings"]["user_id"])
-        }
-        for data in ratings_df_gen:
-            users_dict[data[1]["user_id"]].append(
-                (data[1]["item_id"], data[1]["rating"])
-            )
-            if data[1]["rating"] >= 4:
-                users_dict_for_history_len[data[1]["user_id"]].append(
-                    (data[1]["item_id"], data[1]["rating"])
-                )
-        users_history_lens = [
-            len(users_dict_for_history_len[u])
-            for u in set(datasets["ratings"]["user_id"])
-        ]
+        users_dict = group_ratings_by_user(datasets["ratings"])
+        users_history_lens = count_positive_ratings(
+            datasets["ratings"], list(users_dict)
+        )
 
         users_num = max(datasets["ratings"]["user_id"]) + 1
         items_num = max(datasets["ratings"]["item_id"]) + 1
@@ -201,6 +211,18 @@ class ML20MLoadAndPrepareDataset(luigi.Task):
         with open(self.output()["eval_users_dict"].path, "wb") as file:
             pickle.dump(eval_users_dict, file)
 
+        # positive items of each user, loaded by the environments
+        for split, users_dict in (
+            ("train_histories", train_users_dict),
+            ("eval_histories", eval_users_dict),
+        ):
+            np.savez(
+                self.output()[split].path,
+                **compile_user_histories(
+                    users_dict, self.state_size, self.reward_thresholds
+                ),
+            )
+
         with open(self.output()["users_history_lens"].path, "wb") as file:
             pickle.dump(users_history_lens, file)
 
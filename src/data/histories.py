@@ -0,0 +1,121 @@
+import numpy as np
+
+
+def build_user_histories(users_dict, state_size, reward_threshold):
+    """Compile the feedback log into the arrays used by the environment.
+
+    Parameters
+    ----------
+    users_dict: dictionary
+        User dictionary with interacted items and rate.
+        Format: {user_id: [(item_id, rate), ...]}
+
+    state_size: int
+        Number of items considered in the state.
+
+    reward_threshold: int
+        threshold for considering item rating a positive reward.
+
+    Returns
+    -------
+    histories: dictionary
+        indptr: the items and ratings of user u are at indptr[u]:indptr[u + 1]
+        items: rated items of each user, sorted (last rating of duplicates)
+        ratings: rating of each item
+        initial_items: first state_size positively rated items of each user
+        n_initial: number of initial items of each user
+        available_users: users with more than state_size positive ratings
+    """
+
+    return select_user_histories(
+        compile_user_histories(users_dict, state_size, [reward_threshold]),
+        state_size,
+        reward_threshold,
+    )
+
+
+def compile_user_histories(users_dict, state_size, reward_thresholds):
+    """Compile the feedback log into CSR arrays indexed by user id, with the
+    positive ratings count and the first `state_size` positively rated items
+    of every user for each threshold in `reward_thresholds`.
+
+    The result only holds arrays, so it can be saved with `np.savez` and
+    loaded with `load_user_histories`.
+    """
+
+    users = np.sort(np.fromiter(users_dict.keys(), dtype=np.int64))
+    n_users = int(users.max()) + 1 if len(users) else 0
+    lengths = np.fromiter((len(users_dict[u]) for u in users), dtype=np.int64)
+    log = np.concatenate(
+        [np.asarray(users_dict[u], dtype=np.float64).reshape(-1, 2) for u in users]
+        + [np.empty((0, 2))]
+    )
+    log_users = np.repeat(users, lengths)
+    log_items = log[:, 0].astype(np.int64)
+
+    # sort by user and item, keeping the last rating of an item
+    order = np.lexsort((np.arange(len(log)), log_items, log_users))
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (log_users[order][1:] != log_users[order][:-1]) | (
+        log_items[order][1:] != log_items[order][:-1]
+    )
+    order = order[last]
+    indptr = np.zeros(n_users + 1, dtype=np.int64)
+    np.cumsum(np.bincount(log_users[order], minlength=n_users), out=indptr[1:])
+
+    histories = {
+        "indptr": indptr,
+        "items": log_items[order],
+        "ratings": log[order, 1],
+        "state_size": np.array(state_size),
+    }
+    for reward_threshold in reward_thresholds:
+        # rank of each positive rating within its user, in log order
+        positive_index = np.flatnonzero(log[:, 1] >= reward_threshold)
+        positive_users = log_users[positive_index]
+        n_positive = np.bincount(positive_users, minlength=n_users)
+        first_positive = np.cumsum(n_positive) - n_positive
+        rank = np.arange(len(positive_index)) - first_positive[positive_users]
+        initial = rank < state_size
+        initial_items = np.zeros((n_users, state_size), dtype=np.int64)
+        initial_items[positive_users[initial], rank[initial]] = log_items[
+            positive_index[initial]
+        ]
+
+        histories["n_positive_{:g}".format(reward_threshold)] = n_positive
+        histories["initial_items_{:g}".format(reward_threshold)] = initial_items
+
+    return histories
+
+
+def select_user_histories(histories, state_size, reward_threshold):
+    """Environment arrays (see `build_user_histories`) for one state size and
+    reward threshold of compiled histories. Raises a KeyError if they were
+    not compiled for them."""
+
+    n_positive = histories["n_positive_{:g}".format(reward_threshold)]
+    if state_size > histories["state_size"]:
+        raise KeyError("Histories were compiled for a smaller state_size.")
+
+    return {
+        "indptr": histories["indptr"],
+        "items": histories["items"],
+        "ratings": histories["ratings"],
+        "initial_items": histories["initial_items_{:g}".format(reward_threshold)][
+            :, :state_size
+        ],
+        "n_initial": np.minimum(n_positive, state_size),
+        "available_users": np.flatnonzero(n_positive > state_size),
+    }
+
+
+def load_user_histories(path, state_size, reward_threshold):
+    """Load histories saved from `compile_user_histories`. Returns None if
+    they were not compiled for this state size and reward threshold."""
+
+    with np.load(path) as f:
+        histories = dict(f)
+    try:
+        return select_user_histories(histories, state_size, reward_threshold)
+    except KeyError:
+        return None
@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+
+
+# item features used by each user intent of the fair environment
+INTENT_FEATURES = {
+    "item_emb_pmf": ("pmf",),
+    "item_metadata_emb": ("metadata",),
+    "item_name_emb": ("title",),
+    "item_name_metadata_emb": ("metadata", "title"),
+}
+
+
+def normalize_rows(features):
+    """Scale each row of `features` to unit norm, as a float32 array.
+
+    Zero rows are kept as zeros, so their cosine similarity with any other
+    row is 0 (as in sklearn's cosine_similarity).
+    """
+
+    features = np.asarray(features, dtype=np.float64)
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (features / norms).astype(np.float32)
+
+
+class ItemFeatureStore(object):
+    def __init__(self, features=None):
+        """Dense item features shared by the environments.
+
+        Each feature set is a contiguous float32 array whose row i holds the
+        features of item i, so gathering the rows of a batch of items is a
+        single indexing operation. The store is meant to be built once and
+        passed to every environment: arrays loaded with `load` are
+        read-only memory maps, so forked workers share their pages, and the
+        normalized arrays of the user intents are computed once per store.
+
+
+        Parameters
+        ----------
+
+        features: dictionary
+            Feature arrays by name ('metadata', 'title', 'pmf').
+
+        """
+
+        self.features = {}
+        self.sources = {}
+        self._normalized = {}
+        for name, _features in (features or {}).items():
+            self.add(name, _features)
+
+    @classmethod
+    def from_frames(cls, items_metadata=None, title_emb=None):
+        """Build the store from the dataframes of the dataset stage.
+
+        Parameters
+        ----------
+        items_metadata: dataframe
+            Item metadata, with an item_id column and one-hot columns. The
+            one-hot columns are converted to numbers (they are strings when
+            split from the raw files), and a ValueError is raised if there
+            are none.
+        title_emb: dataframe
+            Title embeddings, row i holding the embedding of item i.
+        """
+
+        features = {}
+        if items_metadata is not None:
+            metadata = items_metadata.set_index("item_id").drop(
+                columns=["metadata"], errors="ignore"
+            )
+            if metadata.shape[1] == 0:
+                raise ValueError("Item metadata has no feature columns.")
+            metadata = metadata.apply(pd.to_numeric)
+            features["metadata"] = np.zeros(
+                (metadata.index.max() + 1, metadata.shape[1]), dtype=np.float32
+            )
+            features["metadata"][metadata.index.values] = metadata.values
+        if title_emb is not None:
+            features["title"] = title_emb.select_dtypes("number").values
+
+        return cls(features)
+
+    @classmethod
+    def load(cls, paths, mmap=True):
+        """Load feature arrays saved with `save`.
+
+        Parameters
+        ----------
+        paths: dictionary
+            Path of the .npy file of each feature set, by name.
+        mmap: bool
+            Memory map the files read-only instead of reading them.
+        """
+
+        return cls(
+            {
+                name: np.load(path, mmap_mode="r" if mmap else None)
+                for name, path in paths.items()
+            }
+        )
+
+    def save(self, name, path):
+        np.save(path, self.features[name])
+
+    def add(self, name, features):
+        """Add (or replace) a feature set.
+
+        Adding the same object again is a no-op, so environments can assign
+        the agent's embeddings without normalizing them again.
+        """
+
+        if self.sources.get(name) is features:
+            return
+        self.sources[name] = features
+
+        if hasattr(features, "cpu"):  # torch tensor
+            features = features.detach().cpu().numpy()
+        self.features[name] = np.ascontiguousarray(features, dtype=np.float32)
+        self._normalized = {
+            names: normalized
+            for names, normalized in self._normalized.items()
+            if name not in names
+        }
+
+    def gather(self, name, items):
+        """Features of `items` in the `name` feature set."""
+
+        return self.features[name][items]
+
+    def normalized(self, names):
+        """Concatenation of the `names` feature sets, with unit norm rows.
+
+        Returns None if one of the feature sets is not in the store.
+        """
+
+        names = tuple(names)
+        if names not in self._normalized:
+            if any(name not in self.features for name in names):
+                return None
+
+            arrays = [self.features[name] for name in names]
+            features = np.zeros(
+                (max(len(a) for a in arrays), sum(a.shape[1] for a in arrays))
+            )
+            offset = 0
+            for array in arrays:
+                features[: len(array), offset : offset + array.shape[1]] = array
+                offset += array.shape[1]
+
+            normalized = normalize_rows(features)
+            normalized.flags.writeable = False
+            self._normalized[names] = normalized
+        return self._normalized[names]
+
+    def intent_features(self, user_intent):
+        """Normalized item features of a user intent of OfflineFairEnv."""
+
+        return self.normalized(INTENT_FEATURES[user_intent])
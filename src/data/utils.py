@@ -5,6 +5,7 @@ import luigi
 import zipfile
 import bz2
 import requests
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
@@ -56,6 +57,41 @@ def split_train_test(data, train_ratio=0.8):
     return train_data, test_data
 
 
+def group_ratings_by_user(ratings):
+    """(item_id, rating) pairs of each user, in the row order of `ratings`.
+
+    Same dictionary as appending the pairs of `ratings.iterrows()` to the
+    list of each user, built with one stable sort by user and a slice per
+    user. Users are in increasing id order.
+    """
+
+    users = ratings["user_id"].to_numpy()
+    order = np.argsort(users, kind="stable")
+    users = users[order]
+    pairs = list(
+        zip(
+            ratings["item_id"].to_numpy()[order].tolist(),
+            ratings["rating"].to_numpy()[order].tolist(),
+        )
+    )
+
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    ends = np.r_[starts[1:], len(users)]
+    return {
+        user: pairs[start:end]
+        for user, start, end in zip(
+            users[starts].tolist(), starts.tolist(), ends.tolist()
+        )
+    }
+
+
+def count_positive_ratings(ratings, users, threshold=4):
+    """Number of ratings of at least `threshold` of each user in `users`."""
+
+    counts = ratings.loc[ratings["rating"] >= threshold, "user_id"].value_counts()
+    return counts.reindex(users, fill_value=0).tolist()
+
+
 class DownloadDataset(luigi.Task, metaclass=abc.ABCMeta):
     output_path: str = luigi.Parameter(default=OUTPUT_PATH)
     dataset: str = luigi.ChoiceParameter(choices=DATASETS.keys())
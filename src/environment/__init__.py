@@ -1,2 +1,4 @@
 from .drr_env import OfflineEnv
 from .fair_env import OfflineFairEnv
+from .vector_env import VectorOfflineEnv
+from src.data.item_features import ItemFeatureStore
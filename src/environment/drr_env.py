@@ -3,6 +3,8 @@ import numpy as np
 import pandas as pd
 from sklearn.metrics.pairwise import cosine_similarity
 
+from src.data.histories import build_user_histories
+
 
 class OfflineEnv(object):
     def __init__(
@@ -17,6 +19,8 @@ class OfflineEnv(object):
         reward_model=None,
         use_only_reward_model=False,
         device="cpu",
+        histories=None,
+        group_index=None,
         **kwargs
     ):
         """Offline environment for recommendation system.
@@ -65,6 +69,15 @@ class OfflineEnv(object):
         use_only_reward_model: boolean
             If set, the environment will only use the reward predictor model.
 
+        histories: dictionary
+            Feedback log compiled by `build_user_histories` with the same
+            state_size and reward_threshold. If not provided, it is compiled
+            from users_dict.
+
+        group_index: dictionary
+            Item groups compiled by `build_group_index`. If not provided, it
+            is compiled from item_groups.
+
 
         References
         ----------
@@ -86,36 +99,30 @@ class OfflineEnv(object):
         self.n_groups = n_groups
         self.item_groups = item_groups
 
+        self.histories = (
+            histories
+            if histories is not None
+            else build_user_histories(users_dict, state_size, reward_threshold)
+        )
+
         # filter users with len_history > state_size
         self.available_users = self._generate_available_users()
 
-        # if not fix_user_id choose a random user
-        self.user = (
-            fix_user_id if fix_user_id else np.random.choice(self.available_users)
+        self.group_index = (
+            group_index
+            if group_index is not None
+            else build_group_index(item_groups, n_groups)
         )
-        # user items and ratings
-        self.user_items = {data[0]: data[1] for data in self.users_dict[self.user]}
-
-        # get last state_size items positively rated by the user in the feedback log
-        self.items = [
-            data[0]
-            for data in self.users_dict[self.user]
-            if data[1] >= reward_threshold
-        ][: self.state_size]
-        self.recommended_items = set(self.items)
-        self.correctly_recommended = set(self.items)
+        self.item_group = self.group_index["item_group"]
+        self.n_items = len(self.item_group)
 
         # get list of items in each group
+        indptr, items = self.group_index["indptr"], self.group_index["items"]
         self.groups_items = {
-            i: [k for k in item_groups if item_groups[k] == i]
-            for i in range(1, n_groups + 1)
+            i: items[indptr[i] : indptr[i + 1]] for i in range(1, n_groups + 1)
         }
 
-        # initialize group count
-        self.group_count = {k: 0 for k in range(1, self.n_groups + 1)}
-        self.total_recommended_items = 0
-
-        self.done = False
+        self.reset()
 
     def _generate_available_users(self):
         """Generate a list of available users.
@@ -127,16 +134,17 @@ class OfflineEnv(object):
             An array of available users.
         """
 
-        available_users = []
-        for u in self.users_dict.keys():
-            positive_items = [
-                data[0]
-                for data in self.users_dict[u]
-                if data[1] >= self.reward_threshold
-            ]
-            if len(positive_items) > self.state_size:
-                available_users.append(u)
-        return available_users
+        return self.histories["available_users"].tolist()
+
+    def _get_rating(self, item):
+        """Rating of the item by the current user in the feedback log, or
+        None if the user did not rate it."""
+
+        start, end = self.user_range
+        index = start + np.searchsorted(self.histories["items"][start:end], item)
+        if index < end and self.histories["items"][index] == item:
+            return self.histories["ratings"][index]
+        return None
 
     def _reward_normalization(self, reward):
         """Normalize reward to [-1, 1]
@@ -179,19 +187,14 @@ class OfflineEnv(object):
 
         reward = None
         if not self.use_only_reward_model:
+            rating = self._get_rating(action)
 
             # If we know the reward according to the feedback log, we use it
-            if (
-                action in self.user_items.keys()
-                and action not in self.recommended_items
-            ):
-                reward = self._reward_normalization(self.user_items[action])
+            if rating is not None and not self.recommended_items[action]:
+                reward = self._reward_normalization(rating)
 
             # If we dont know the reward, use reward predictor
-            elif (
-                action not in self.user_items.keys()
-                and action not in self.recommended_items
-            ):
+            elif rating is None and not self.recommended_items[action]:
                 if self.reward_model:
                     # reward = float(
                     #     self.reward_model.predict(
@@ -202,13 +205,11 @@ class OfflineEnv(object):
                     #     .cpu()
                     #     .numpy()[0]
                     # )
-                    reward = self.reward_model.predict(np.array([[self.user, action]]))[
-                        0
-                    ]
+                    reward = self._model_reward(action)
                 else:
                     reward = 0
 
-        elif self.use_only_reward_model and (action not in self.recommended_items):
+        elif self.use_only_reward_model and (not self.recommended_items[action]):
             # reward = float(
             #     self.reward_model.predict(
             #         torch.tensor([self.user]).long().to(self.device),
@@ -218,10 +219,44 @@ class OfflineEnv(object):
             #     .cpu()
             #     .numpy()[0]
             # )
-            reward = self.reward_model.predict(np.array([[self.user, action]]))[0]
+            reward = self._model_reward(action)
 
         return reward
 
+    def _model_reward(self, action):
+        if action in self.predicted_rewards:
+            return self.predicted_rewards[action]
+        return self._predict_rewards([action])[0]
+
+    def _predict_rewards(self, actions):
+        """Reward model predictions of the current user for `actions`."""
+
+        actions = np.asarray(actions, dtype=np.int64)
+        return self.reward_model.predict(
+            np.column_stack((np.full(len(actions), self.user), actions))
+        )
+
+    def prefetch_rewards(self, actions, rewards=None):
+        """Keep the reward model predictions of the actions of the next step,
+        so they are not queried one item at a time.
+
+        Parameters
+        ----------
+        actions: int or array
+            Action of the next step.
+        rewards: array
+            Predictions for the actions, if already computed (e.g. batched
+            across environments). Otherwise the reward model is queried once.
+        """
+
+        if not self.reward_model:
+            return
+
+        actions = np.atleast_1d(actions)
+        if rewards is None:
+            rewards = self._predict_rewards(actions)
+        self.predicted_rewards = dict(zip(actions.tolist(), rewards))
+
     def get_recommended_items(self):
         """Get recommended items.
         Get the recommended items for the current user.
@@ -229,7 +264,8 @@ class OfflineEnv(object):
         Returns
         ----------
         recommended_items: array
-            Array of items recommended for the current user.
+            Boolean mask of the items recommended to the current user in
+            the episode (including the initial state), indexed by item id.
         """
 
         return self.recommended_items
@@ -243,7 +279,7 @@ class OfflineEnv(object):
         group_count: array
             Array of items recommended in each group.
         """
-        return list(self.group_count.values())
+        return self.group_count[1:].tolist()
 
     def reset(self):
         """Reset the environment.
@@ -263,26 +299,31 @@ class OfflineEnv(object):
         # if not fix_user_id choose a random user
         self.user = (
             self.fix_user_id
-            if self.fix_user_id
+            if self.fix_user_id is not None
             else np.random.choice(self.available_users)
         )
 
         # user items and ratings
-        self.user_items = {data[0]: data[1] for data in self.users_dict[self.user]}
+        self.user_range = self.histories["indptr"][self.user : self.user + 2]
 
         # get last state_size items positively rated by the user in the feedback log
-        self.items = [
-            data[0]
-            for data in self.users_dict[self.user]
-            if data[1] >= self.reward_threshold
-        ][: self.state_size]
-        self.recommended_items = set(self.items)
-        self.correctly_recommended = set(self.items)
-
-        # reset group count
-        self.group_count = {k: 0 for k in range(1, self.n_groups + 1)}
+        self.items = self.histories["initial_items"][
+            self.user, : self.histories["n_initial"][self.user]
+        ].tolist()
+
+        # recommended and correctly recommended items, as boolean masks by
+        # item id (new arrays every episode, like the group count)
+        self.recommended_items = np.zeros(self.n_items, dtype=bool)
+        self.recommended_items[self.items] = True
+        self.correctly_recommended = self.recommended_items.copy()
+
+        # reset group count, indexed by group id
+        self.group_count = np.zeros(self.n_groups + 1, dtype=np.int64)
         self.total_recommended_items = 0
 
+        # reward model predictions of the next step, see prefetch_rewards
+        self.predicted_rewards = {}
+
         self.done = False
         return self.user, self.items, self.done
 
@@ -311,10 +352,13 @@ class OfflineEnv(object):
         """
 
         if top_k:
+            if not self.predicted_rewards:
+                self.prefetch_rewards(action)
+
             precision = []
             correctly_recommended, rewards = [], []
             for act in action:
-                self.group_count[self.item_groups[act]] += 1
+                self.group_count[self.item_group[act]] += 1
                 self.total_recommended_items += 1
 
                 _reward = self._get_reward(act)
@@ -323,8 +367,8 @@ class OfflineEnv(object):
 
                 if _reward > 0:
                     correctly_recommended.append(act)
-                    self.correctly_recommended.add(act)
-                self.recommended_items.add(act)
+                    self.correctly_recommended[act] = True
+                self.recommended_items[act] = True
                 precision.append(1 if _reward > 0 else 0)
 
             if max(precision) > 0:
@@ -336,18 +380,19 @@ class OfflineEnv(object):
 
         else:
             precision = 0
-            self.group_count[self.item_groups[action]] += 1
+            self.group_count[self.item_group[action]] += 1
             self.total_recommended_items += 1
 
             reward = self._get_reward(action)
             reward = reward if reward else -1.5
             if reward > 0:
                 self.items = self.items[1:] + [action]
-                self.correctly_recommended.add(action)
+                self.correctly_recommended[action] = True
 
-            self.recommended_items.add(action)
+            self.recommended_items[action] = True
             precision += 1 if reward > 0 else 0
 
+        self.predicted_rewards = {}
         if self.total_recommended_items >= self.done_count:
             self.done = True
 
@@ -362,3 +407,36 @@ class OfflineEnv(object):
                 "fairness": 0,
             },
         )
+
+
+def build_group_index(item_groups, n_groups):
+    """Compile the item groups into a dense array and an inverted index.
+
+    Parameters
+    ----------
+    item_groups: dictionary
+        Dictionary of item groups.
+        Format: {item_id: group_id}
+
+    n_groups: int
+        Number of groups of items.
+
+    Returns
+    -------
+    group_index: dictionary
+        item_group: group of each item id (0 if the item has no group)
+        indptr: the items of group g are at items[indptr[g]:indptr[g + 1]]
+        items: item ids sorted by group
+    """
+
+    items = np.fromiter(item_groups.keys(), dtype=np.int64, count=len(item_groups))
+    groups = np.fromiter(item_groups.values(), dtype=np.int64, count=len(item_groups))
+
+    item_group = np.zeros(items.max() + 1 if len(items) else 0, dtype=np.int64)
+    item_group[items] = groups
+
+    order = np.argsort(groups, kind="stable")
+    indptr = np.zeros(n_groups + 2, dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=n_groups + 1), out=indptr[1:])
+
+    return {"item_group": item_group, "indptr": indptr, "items": items[order]}
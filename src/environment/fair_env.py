@@ -1,9 +1,9 @@
 import numpy as np
 import math
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
 import torch
 from .drr_env import OfflineEnv
+from src.data.item_features import INTENT_FEATURES, ItemFeatureStore
 
 
 class OfflineFairEnv(OfflineEnv):
@@ -26,6 +26,9 @@ class OfflineFairEnv(OfflineEnv):
         reward_model=None,
         use_only_reward_model=False,
         device="cpu",
+        histories=None,
+        group_index=None,
+        item_features=None,
     ):
         """Offline fair environment for recommendation system.
 
@@ -88,6 +91,10 @@ class OfflineFairEnv(OfflineEnv):
         use_only_reward_model: boolean
             If set, the environment will only use the reward predictor model.
 
+        item_features: ItemFeatureStore
+            Item features shared by the environments. If not provided, they
+            are built from items_metadata and the title embeddings file.
+
 
         References
         ----------
@@ -109,6 +116,8 @@ class OfflineFairEnv(OfflineEnv):
             reward_model=reward_model,
             use_only_reward_model=use_only_reward_model,
             device=device,
+            histories=histories,
+            group_index=group_index,
         )
 
         self.reward_version = reward_version
@@ -124,15 +133,72 @@ class OfflineFairEnv(OfflineEnv):
         #     else None
         # )
 
+        self.item_features = item_features
+        if self.item_features is None:
+            self.item_features = ItemFeatureStore.from_frames(
+                items_metadata=(
+                    items_metadata if "metadata" in self.user_intent else None
+                ),
+                title_emb=(
+                    pd.read_csv(title_emb_path)
+                    if ("item_name" in self.user_intent) and title_emb_path
+                    else None
+                ),
+            )
+
+        # normalized item features of the user intent, indexed by item id
+        self.intent_features = None
+        if self.user_intent in INTENT_FEATURES:
+            self.intent_features = self.item_features.intent_features(self.user_intent)
+
         self.item_embeddings = None
         # (self.emb_model.item_embeddings.weight.data if self.reward_model else None)
 
         self.items_metadata = self.items_metadata.set_index("item_id")
         self.items_metadata = self.items_metadata[["metadata"]]
 
-        self.title_emb = None
-        if ("item_name" in self.user_intent) and title_emb_path:
-            self.title_emb = pd.read_csv(title_emb_path)
+    @property
+    def item_embeddings(self):
+        return self._item_embeddings
+
+    @item_embeddings.setter
+    def item_embeddings(self, item_embeddings):
+        # the agent sets the PMF item embeddings after construction
+        self._item_embeddings = item_embeddings
+        if self.user_intent == "item_emb_pmf" and item_embeddings is not None:
+            self.item_features.add("pmf", item_embeddings)
+            self.intent_features = self.item_features.intent_features(self.user_intent)
+        self.intent_sum = None
+
+    def reset(self):
+        user, items, done = super().reset()
+
+        # correctly recommended items in insertion order, and the running
+        # sums of their normalized features (built on the first intent query)
+        self.intent_items = list(dict.fromkeys(items))
+        self.intent_sum = None
+        return user, items, done
+
+    def _add_correctly_recommended(self, item):
+        if self.correctly_recommended[item]:
+            return
+        self.correctly_recommended[item] = True
+        self.intent_items.append(item)
+
+        if self.intent_sum is not None:
+            self._add_intent_item(item, 1)
+            if len(self.intent_items) > self._intent_window():
+                self._add_intent_item(self.intent_items[-self._intent_window() - 1], -1)
+
+    def _intent_window(self):
+        # the PMF intent only considers the last 5 correctly recommended items
+        return 5 if self.user_intent == "item_emb_pmf" else len(self.intent_items)
+
+    def _add_intent_item(self, item, sign):
+        # not in place, the sums may be shared with shallow copies of the env
+        feature = self.intent_features[item].astype(np.float64)
+        self.intent_sum = self.intent_sum + sign * feature
+        self.intent_sq_norm = self.intent_sq_norm + sign * np.dot(feature, feature)
 
     def _get_user_intent(self):
         """Get user intent.
@@ -147,67 +213,36 @@ class OfflineFairEnv(OfflineEnv):
         User intent is the cosine similarity between all items positively rated by the user.
         If user_intent = 0 the user likes similar items.
         If user_intent = 1 the user likes different items.
+
+        The mean pairwise cosine similarity is computed from the running sum
+        `s` of the normalized item features: the sum over all pairs is
+        (|s|^2 - sum |v|^2) / 2, so each new item costs O(d).
         """
 
-        if self.user_intent == "item_emb_pmf":  # Item embedding PMF
-            user_intent = pd.DataFrame(
-                self.item_embeddings[list(self.correctly_recommended)[-5:]]
-                .cpu()
-                .numpy()
+        if self.user_intent not in INTENT_FEATURES:
+            raise ValueError("Not valid user intent")
+        if self.intent_features is None:
+            raise ValueError(
+                "Item features of the '{}' user intent are not available.".format(
+                    self.user_intent
+                )
             )
-            user_intent = cosine_similarity(user_intent, user_intent)[
-                np.triu_indices(user_intent.shape[0], k=1)
-            ]
-            user_intent = (user_intent + 1) / 2
-            user_intent = user_intent.mean()
-
-        elif (
-            self.user_intent == "item_metadata_emb"
-        ):  # where metadata is onehot encoded
-            user_intent = self.items_metadata[
-                self.items_metadata.index.isin(list(self.correctly_recommended))
-            ]
-            user_intent = user_intent.drop(columns=["item_id", "metadata"], axis=1)
-            user_intent = cosine_similarity(user_intent, user_intent)[
-                np.triu_indices(user_intent.shape[0], k=1)
-            ]
-            user_intent = (user_intent + 1) / 2
-            user_intent = user_intent.mean()
-
-        elif self.user_intent == "item_name_emb":  # Item name bert embedding
-            _items_df = self.items_df[
-                self.items_df["item_id"].isin(list(self.correctly_recommended))
-            ]
-
-            user_intent = self.title_emb.loc[_items_df["item_id"].tolist()]
-            user_intent = cosine_similarity(user_intent, user_intent)[
-                np.triu_indices(user_intent.shape[0], k=1)
-            ]
-            user_intent = (user_intent + 1) / 2
-            user_intent = user_intent.mean()
-
-        elif (
-            self.user_intent == "item_name_metadata_emb"
-        ):  # Item name bert embedding + metadata
-            _items_df = self.items_df[
-                self.items_df["item_id"].isin(list(self.correctly_recommended))
-            ]
-
-            user_intent = self.items_metadata[
-                self.items_metadata.index.isin(list(self.correctly_recommended))
-            ]
-            user_intent = user_intent.drop(["metadata"], axis=1).values
-            sentence_embeddings = self.title_emb.loc[_items_df["item_id"].tolist()]
-
-            user_intent = np.concatenate((user_intent, sentence_embeddings), axis=1)
-            user_intent = cosine_similarity(user_intent, user_intent)[
-                np.triu_indices(user_intent.shape[0], k=1)
-            ]
-            user_intent = (user_intent + 1) / 2
-            user_intent = user_intent.mean()
 
-        else:
-            raise "Not valid user intent"
+        n_items = min(len(self.intent_items), self._intent_window())
+        if self.intent_sum is None:
+            features = self.intent_features[self.intent_items[-n_items:]]
+            features = features.astype(np.float64)
+            self.intent_sum = features.sum(0)
+            self.intent_sq_norm = np.sum(features * features)
+
+        n_pairs = n_items * (n_items - 1) / 2
+        if not n_pairs:
+            return np.float64(np.nan)
+
+        user_intent = (
+            (np.dot(self.intent_sum, self.intent_sum) - self.intent_sq_norm) / 2
+        ) / n_pairs
+        user_intent = (user_intent + 1) / 2
         return 1 - user_intent
 
     def _get_fair_reward(self, group, reward):
@@ -314,11 +349,14 @@ class OfflineFairEnv(OfflineEnv):
             Format: {'recommended_items': recommended_items, 'precision': precision}
         """
         if top_k:
+            if not self.predicted_rewards:
+                self.prefetch_rewards(action)
+
             correctly_recommended = []
             rewards = []
             precision = []
             for act in action:
-                group = self.item_groups[act]
+                group = self.item_group[act]
                 self.group_count[group] += 1
                 self.total_recommended_items += 1
 
@@ -329,9 +367,9 @@ class OfflineFairEnv(OfflineEnv):
 
                 if _reward > 0:
                     correctly_recommended.append(act)
-                    self.correctly_recommended.add(act)
+                    self._add_correctly_recommended(act)
 
-                self.recommended_items.add(act)
+                self.recommended_items[act] = True
                 precision.append(1 if _reward > 0 else 0)
 
             if max(precision) > 0:
@@ -342,7 +380,7 @@ class OfflineFairEnv(OfflineEnv):
             reward = rewards
 
         else:
-            group = self.item_groups[action]
+            group = self.item_group[action]
             self.group_count[group] += 1
             self.total_recommended_items += 1
 
@@ -352,13 +390,14 @@ class OfflineFairEnv(OfflineEnv):
 
             if _reward > 0:
                 self.items = self.items[1:] + [action]
-                self.correctly_recommended.add(action)
+                self._add_correctly_recommended(action)
 
-            self.recommended_items.add(action)
+            self.recommended_items[action] = True
             precision = 1 if _reward > 0 else 0
 
             reward = _fair_reward
 
+        self.predicted_rewards = {}
         if self.total_recommended_items >= self.done_count:
             self.done = True
 
@@ -0,0 +1,130 @@
+import copy
+import numpy as np
+
+
+class VectorOfflineEnv(object):
+    def __init__(self, envs):
+        """Run the episodes of several offline environments in lockstep.
+
+        Every environment holds its own user and episode. `step` takes one
+        action per environment, and the environments whose episode is done
+        are reset right away, so `users` and `items` always hold the
+        current observation of every environment.
+
+
+        Parameters
+        ----------
+
+        envs: list
+            Environments (OfflineEnv or OfflineFairEnv) to run.
+
+        """
+
+        self.envs = envs
+        self.n_envs = len(envs)
+
+        self.users = np.zeros(self.n_envs, dtype=np.int64)
+        self.items = [None] * self.n_envs
+
+    @classmethod
+    def from_env(cls, env, n_envs):
+        """Build a vector environment from `n_envs` copies of `env`.
+
+        The copies are shallow: the feedback log, the available users and
+        the reward model are shared, and every copy gets its own episode
+        state on reset.
+        """
+
+        return cls([env] + [copy.copy(env) for _ in range(n_envs - 1)])
+
+    def reset(self):
+        """Reset every environment.
+
+        Returns
+        -------
+        users: array
+            User id of each environment.
+        items: list
+            State items of each environment.
+        dones: array
+            If the episode of each environment is done.
+        """
+
+        for i in range(self.n_envs):
+            self._reset(i)
+        return self.users, self.items, np.zeros(self.n_envs, dtype=bool)
+
+    def _reset(self, i):
+        self.users[i], self.items[i], _ = self.envs[i].reset()
+
+    def get_recommended_items(self):
+        """Recommended items of each environment."""
+
+        return [env.get_recommended_items() for env in self.envs]
+
+    def get_group_count(self):
+        """Group count of each environment, as a (n_envs, n_groups) array."""
+
+        return np.array([env.get_group_count() for env in self.envs])
+
+    def step(self, actions, top_k=False):
+        """Step every environment.
+
+        Parameters
+        ----------
+        actions: array
+            Action of each environment.
+        top_k: bool
+            If True, the action of each environment is an array of top k
+            recommended items.
+
+        Returns
+        ----------
+        next_items_ids: list
+            Next state items of each environment, before the auto reset.
+        rewards: list
+            Reward of each environment.
+        dones: array
+            If the episode of each environment is done. Those environments
+            have already been reset.
+        infos: list
+            Extra information of each environment. The group count at the
+            end of the step is added under 'group_count'.
+        """
+
+        self._prefetch_rewards(actions)
+
+        next_items_ids, rewards, infos = [], [], []
+        dones = np.zeros(self.n_envs, dtype=bool)
+        for i, (env, action) in enumerate(zip(self.envs, actions)):
+            _next_items_ids, reward, done, info = env.step(action, top_k=top_k)
+            info["group_count"] = env.get_group_count()
+
+            next_items_ids.append(_next_items_ids)
+            rewards.append(reward)
+            dones[i] = done
+            infos.append(info)
+
+            if done:
+                self._reset(i)
+            else:
+                self.items[i] = _next_items_ids
+
+        return next_items_ids, rewards, dones, infos
+
+    def _prefetch_rewards(self, actions):
+        # score the (user, item) pairs of every environment in one reward
+        # model call
+        env = self.envs[0]
+        if not env.reward_model:
+            return
+
+        actions = [np.atleast_1d(action) for action in actions]
+        lengths = [len(action) for action in actions]
+        rewards = env.reward_model.predict(
+            np.column_stack((np.repeat(self.users, lengths), np.concatenate(actions)))
+        )
+        for env, action, _rewards in zip(
+            self.envs, actions, np.split(rewards, np.cumsum(lengths)[:-1])
+        ):
+            env.prefetch_rewards(action, _rewards)
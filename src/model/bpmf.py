@@ -7,6 +7,7 @@ Reference Matlab code: http://www.cs.toronto.edu/~rsalakhu/BPMF.html
 """
 
 import logging
+from collections import OrderedDict
 import numpy as np
 from numpy.linalg import inv, cholesky
 from numpy.random import RandomState
@@ -175,6 +176,24 @@ class BPMF(object):
             preds[preds < self.min_rating] = self.min_rating
         return preds
 
+    def predict_user(self, user):
+        """Predicted rating of every item by `user`, as in `predict`."""
+
+        if not self.mean_rating_:
+            raise NotFittedError()
+
+        preds = (
+            np.sum(self.avg_user_features_[int(user)] * self.avg_item_features_, 1)
+            + self.mean_rating_
+        )
+
+        if self.max_rating:  # cut the prediction rate.
+            preds[preds > self.max_rating] = self.max_rating
+
+        if self.min_rating:
+            preds[preds < self.min_rating] = self.min_rating
+        return preds
+
     def _update_item_params(self):
         N = self.n_item
         X_bar = np.mean(self.item_features_, 0).reshape((self.n_feature, 1))
@@ -284,3 +303,64 @@ class BPMF(object):
             mean = np.dot(covar, temp)
             temp_feature = mean + np.dot(lam, self.rand_state.randn(self.n_feature, 1))
             self.user_features_[user_id, :] = temp_feature.ravel()
+
+
+class UserScoreCache(object):
+    """Reward model wrapper keeping the predicted ratings of recent users.
+
+    The first query of a user scores every item once with
+    `model.predict_user`, and later queries of that user are lookups in the
+    stored row. Rows are evicted in least recently used order once they
+    take more than `max_bytes`.
+
+    Parameters
+    ----------
+    model: BPMF
+        Fitted reward model.
+    max_bytes: int
+        Memory budget of the stored rows.
+    """
+
+    def __init__(self, model, max_bytes=256 * 2**20):
+        self.model = model
+        self.max_bytes = max_bytes
+
+        self.rows = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def predict_user(self, user):
+        user = int(user)
+        row = self.rows.get(user)
+        if row is not None:
+            self.rows.move_to_end(user)
+            self.hits += 1
+            return row
+
+        self.misses += 1
+        row = self.model.predict_user(user)
+        row.flags.writeable = False  # rows are shared by every caller
+
+        self.rows[user] = row
+        self.n_bytes += row.nbytes
+        while self.n_bytes > self.max_bytes and len(self.rows) > 1:
+            _, evicted = self.rows.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+        return row
+
+    def predict(self, data):
+        users = data.take(0, axis=1).astype(int)
+        items = data.take(1, axis=1).astype(int)
+        if len(users) and (users == users[0]).all():
+            return self.predict_user(users[0])[items]
+
+        preds = np.empty(len(users))
+        for user in np.unique(users):
+            mask = users == user
+            preds[mask] = self.predict_user(user)[items[mask]]
+        return preds
+
+    def clear(self):
+        self.rows.clear()
+        self.n_bytes = 0
@@ -0,0 +1,353 @@
+import hashlib
+import io
+import json
+import os
+import threading
+
+import numpy as np
+import torch
+
+try:
+    from safetensors import safe_open
+    from safetensors.torch import save_file
+except ImportError:
+    safe_open = None
+    save_file = None
+
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _join(key, name):
+    return "{}.{}".format(key, name) if key else str(name)
+
+
+def pack_state(state, key, tensors):
+    """JSON-able copy of `state`, with its tensors and arrays moved to
+    `tensors` under dotted keys (CPU copies, so they can be written while
+    the originals keep changing)."""
+
+    if torch.is_tensor(state):
+        if key in tensors:
+            raise ValueError("Duplicated checkpoint tensor {}".format(key))
+        tensors[key] = state.detach().to("cpu", copy=True).contiguous()
+        return {"tensor": key}
+    if isinstance(state, np.ndarray):
+        pack_state(torch.from_numpy(state), key, tensors)
+        return {"ndarray": key}
+    if isinstance(state, np.generic):
+        return state.item()
+    if isinstance(state, dict):
+        return {
+            "dict": [
+                [k, pack_state(v, _join(key, k), tensors)] for k, v in state.items()
+            ]
+        }
+    if isinstance(state, (list, tuple)):
+        return {
+            "tuple" if isinstance(state, tuple) else "list": [
+                pack_state(v, _join(key, i), tensors) for i, v in enumerate(state)
+            ]
+        }
+    return state
+
+
+def unpack_state(state, get_tensor):
+    """Inverse of `pack_state`, reading the tensors with `get_tensor`."""
+
+    if not isinstance(state, dict):
+        return state
+    if "tensor" in state:
+        return get_tensor(state["tensor"])
+    if "ndarray" in state:
+        return get_tensor(state["ndarray"]).cpu().numpy()
+    if "dict" in state:
+        return {k: unpack_state(v, get_tensor) for k, v in state["dict"]}
+    if "tuple" in state:
+        return tuple(unpack_state(v, get_tensor) for v in state["tuple"])
+    return [unpack_state(v, get_tensor) for v in state["list"]]
+
+
+def write_checkpoint(path, tensors, header):
+    """Write the tensors and the JSON header of a packed state to the single
+    file `path`, atomically (through a temporary file).
+
+    The file is a safetensors file when safetensors is installed, a
+    torch.save file otherwise.
+    """
+
+    tmp_path = path + ".tmp"
+    if save_file is not None:
+        save_file(tensors, tmp_path, metadata={"header": header})
+    else:
+        torch.save({"header": header, "tensors": tensors}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class ConsolidatedCheckpoint(object):
+    """Reader of a checkpoint file written by `write_checkpoint`.
+
+    Opening the file only reads its header, tensors are read when they are
+    requested (safetensors reads each tensor on `get_tensor`, torch.save
+    files are memory mapped), so loading the networks of a checkpoint does
+    not read its optimizer states.
+
+    Parameters
+    ----------
+    path: str
+        Checkpoint file.
+    map_location: str or torch.device
+        Device of the returned tensors.
+    """
+
+    def __init__(self, path, map_location=None):
+        self.path = path
+        self.map_location = map_location
+
+        if path.endswith(".safetensors"):
+            self._file = safe_open(path, framework="pt", device="cpu")
+            header = self._file.metadata()["header"]
+        else:
+            self._file = torch.load(path, map_location="cpu", mmap=True)
+            header = self._file["header"]
+        header = json.loads(header)
+        self.step = header["step"]
+        self.header = header["state"]
+
+    def get_tensor(self, key):
+        if isinstance(self._file, dict):
+            tensor = self._file["tensors"][key]
+        else:
+            tensor = self._file.get_tensor(key)
+        return tensor.to(self.map_location) if self.map_location else tensor
+
+    def keys(self):
+        return [key for key, _ in self.header["dict"]]
+
+    def load(self, *path):
+        """State under the keys `path`, e.g. load('actor', 'network')."""
+
+        state = self.header
+        for key in path:
+            state = dict(state["dict"])[key]
+        return unpack_state(state, self.get_tensor)
+
+
+class CheckpointManager(object):
+    """Latest checkpoint of an agent, tracked by a manifest.
+
+    Checkpoints saved with `save` are single `checkpoint_<step>` files
+    holding the whole learner state (see `write_checkpoint`), written on a
+    background thread. Every recorded checkpoint rewrites `manifest.json`
+    in `model_path` (atomically, through a temporary file) with the
+    checkpoint step, its files and their sha256 hashes, and bumps its
+    version. Finding the latest checkpoint is a stat of the manifest, and
+    the loaded state dicts are cached by manifest version, so they are only
+    read from disk again after a new checkpoint is recorded.
+
+    Model directories written before the manifest existed are scanned for
+    the latest `<network>_<step>.h5` files instead, again only when the
+    directory changes.
+
+    Parameters
+    ----------
+    model_path: str
+        Directory of the checkpoints.
+    networks: tuple
+        Names of the checkpointed networks.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, model_path, networks=("actor", "critic", "srm")):
+        self.model_path = model_path
+        self.networks = networks
+        self.manifest_path = os.path.join(model_path, self.MANIFEST)
+
+        self._manifest = None
+        self._manifest_stat = None
+        self._state_dicts = None
+        self._state_dicts_key = None
+
+        self._thread = None
+        self._error = None
+
+    def checkpoint_path(self, step):
+        return os.path.join(
+            self.model_path,
+            "checkpoint_{}.{}".format(step, "safetensors" if save_file else "pt"),
+        )
+
+    def record(self, step, paths):
+        """Make the checkpoint of `step`, saved to `paths`, the latest one."""
+
+        manifest = self.manifest()
+        manifest = {
+            "version": (manifest["version"] or 0) + 1 if manifest else 1,
+            "step": step,
+            "files": {name: os.path.basename(path) for name, path in paths.items()},
+            "sha256": {name: file_sha256(path) for name, path in paths.items()},
+        }
+
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def save(self, step, state, background=True):
+        """Save `state` as the checkpoint of `step` and record it.
+
+        The tensors of `state` are copied before returning, so the caller
+        can keep updating them, while the file is written and recorded on a
+        background thread unless `background` is False. A save waits for
+        the previous one to finish.
+
+        Parameters
+        ----------
+        step: int
+            Step (episode) of the checkpoint.
+        state: dictionary
+            Nested dicts, lists and tuples of tensors, arrays and JSON
+            values, as in `pack_state`.
+        background: bool
+            Write the file on a background thread.
+        """
+
+        self.wait()
+
+        tensors = {}
+        header = json.dumps({"step": step, "state": pack_state(state, "", tensors)})
+        path = self.checkpoint_path(step)
+        if not background:
+            self._save(step, path, tensors, header)
+            return
+
+        self._thread = threading.Thread(
+            target=self._save_in_background, args=(step, path, tensors, header)
+        )
+        self._thread.start()
+
+    def _save(self, step, path, tensors, header):
+        write_checkpoint(path, tensors, header)
+        self.record(step, {"checkpoint": path})
+
+    def _save_in_background(self, *args):
+        try:
+            self._save(*args)
+        except BaseException as e:
+            self._error = e
+
+    def wait(self):
+        """Wait for the save in progress, and raise its error if it failed."""
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Checkpoint save failed") from error
+
+    def manifest(self):
+        """Manifest of the latest checkpoint, None if there is no checkpoint."""
+
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return self._scan()
+
+        key = ("manifest", stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key != self._manifest_stat:
+            with open(self.manifest_path) as f:
+                self._manifest = json.load(f)
+            self._manifest_stat = key
+        return self._manifest
+
+    def _scan(self):
+        # latest checkpoint of each network in a directory without manifest
+        try:
+            stat = os.stat(self.model_path)
+        except FileNotFoundError:
+            return None
+
+        key = ("scan", stat.st_mtime_ns)
+        if key != self._manifest_stat:
+            steps = {name: [] for name in self.networks}
+            for f in os.listdir(self.model_path):
+                name, _, step = os.path.splitext(f)[0].partition("_")
+                if name in steps and step.isdigit():
+                    steps[name].append(int(step))
+
+            self._manifest = None
+            if all(steps.values()):
+                self._manifest = {
+                    "version": None,
+                    "step": max(steps[self.networks[0]]),
+                    "files": {
+                        name: "{}_{}.h5".format(name, max(steps[name]))
+                        for name in self.networks
+                    },
+                    "sha256": {},
+                }
+            self._manifest_stat = key
+        return self._manifest
+
+    def open(self, map_location=None):
+        """Reader of the latest checkpoint, None if it is not a single file
+        checkpoint saved with `save`."""
+
+        self.wait()
+        manifest = self.manifest()
+        if manifest is None:
+            raise FileNotFoundError("No checkpoint in {}".format(self.model_path))
+        if "checkpoint" not in manifest["files"]:
+            return None
+
+        return ConsolidatedCheckpoint(
+            os.path.join(self.model_path, manifest["files"]["checkpoint"]),
+            map_location=map_location,
+        )
+
+    def load_state_dicts(self, map_location=None):
+        """State dicts of the latest checkpoint, by network name.
+
+        The returned dicts are cached and shared by every caller, load them
+        into the networks with load_state_dict (which copies them). Only the
+        network tensors of a single file checkpoint are read, and they are
+        not checked against the manifest hash, which would read the whole
+        file.
+        """
+
+        self.wait()
+        manifest = self.manifest()
+        if manifest is None:
+            raise FileNotFoundError("No checkpoint in {}".format(self.model_path))
+
+        key = (manifest["version"], tuple(sorted(manifest["files"].items())))
+        if key != self._state_dicts_key:
+            checkpoint = self.open(map_location)
+            if checkpoint is not None:
+                state_dicts = {
+                    name: checkpoint.load(name, "network") for name in self.networks
+                }
+            else:
+                state_dicts = self._load_files(manifest, map_location)
+
+            self._state_dicts = state_dicts
+            self._state_dicts_key = key
+        return self._state_dicts
+
+    def _load_files(self, manifest, map_location):
+        # one state dict file per network
+        state_dicts = {}
+        for name, f in manifest["files"].items():
+            with open(os.path.join(self.model_path, f), "rb") as handle:
+                data = handle.read()
+            if name in manifest["sha256"]:
+                if hashlib.sha256(data).hexdigest() != manifest["sha256"][name]:
+                    raise ValueError(
+                        "Checkpoint file {} does not match the manifest.".format(f)
+                    )
+            state_dicts[name] = torch.load(io.BytesIO(data), map_location=map_location)
+        return state_dicts
@@ -2,21 +2,38 @@ import os
 import pickle
 from tqdm import tqdm
 import math
+import multiprocessing
+import random
+import traceback
 
 import torch
 import numpy as np
 import pickle
 from src.model.pmf import PMF
+from src.model.bpmf import UserScoreCache
+from src.model.checkpoint import CheckpointManager
 from src.model.actor import Actor
 from src.model.critic import Critic
 from src.model.ou_noise import OUNoise
-from src.model.replay_buffer import PriorityExperienceReplay
+from src.model.replay_buffer import (
+    PriorityExperienceReplay,
+    CompactPriorityExperienceReplay,
+    DiskPriorityExperienceReplay,
+    ShardedPriorityExperienceReplay,
+)
 from src.model.state_representation import StateRepresentation
+from src.environment import VectorOfflineEnv
 
-import wandb
+try:
+    import wandb
+except ImportError:
+    wandb = None
 
 
 class DRRAgent:
+    # online evaluation records the user intent of the environment
+    track_user_intent = False
+
     def __init__(
         self,
         env,
@@ -45,6 +62,13 @@ class DRRAgent:
         fairness_constraints=[0.25, 0.25, 0.25, 0.25],
         no_cuda=False,
         use_reward_model=True,
+        compact_buffer=False,
+        buffer_path=None,
+        n_step=1,
+        sequence_length=1,
+        n_actors=1,
+        n_envs=1,
+        reward_cache_mb=0,
     ):
         # no_cuda = True
         self.device = torch.device(
@@ -57,6 +81,7 @@ class DRRAgent:
         self.items_num = items_num
 
         self.model_path = model_path
+        self.checkpoints = CheckpointManager(self.model_path)
 
         self.reward_model_path = reward_model_path
         self.embedding_network_weights_path = embedding_network_weights_path
@@ -74,6 +99,15 @@ class DRRAgent:
         self.learning_starts = learning_starts
         self.replay_memory_size = replay_memory_size
         self.batch_size = batch_size
+        self.n_step = n_step
+        self.sequence_length = sequence_length
+        self.n_actors = n_actors
+        self.n_envs = n_envs
+        if n_envs > 1 and (compact_buffer or n_step > 1):
+            # transitions of the environments are interleaved in the buffer
+            raise ValueError(
+                "Vectorized training does not support compact or n-step buffers."
+            )
 
         self.n_groups = n_groups
         self.fairness_constraints = fairness_constraints
@@ -117,6 +151,12 @@ class DRRAgent:
 
         with open(self.reward_model_path, "rb") as handle:
             self.reward_model = pickle.load(handle)
+        if reward_cache_mb:
+            # keep the score rows of recent users, so replayed users are
+            # served by lookups
+            self.reward_model = UserScoreCache(
+                self.reward_model, max_bytes=reward_cache_mb * 2**20
+            )
 
         # self.user_embeddings = (
         #     torch.tensor(self.reward_model.user_features_).float().to(self.device)
@@ -134,22 +174,67 @@ class DRRAgent:
             self.env.item_embeddings = self.item_embeddings
             self.env.device = self.device
 
-        self.buffer = PriorityExperienceReplay(
-            buffer_size=self.replay_memory_size,
-            embedding_dim=self.embedding_dim,
-            obs_size=1 + self.state_size + self.n_groups,
-            device=self.device,
-        )
+        if n_actors > 1:
+            if compact_buffer or buffer_path:
+                raise ValueError(
+                    "Multiple actors require the default (shared) replay buffer."
+                )
+            if self.device.type == "cuda":
+                raise ValueError("Multiple actors are only supported on the CPU.")
+            self.buffer = ShardedPriorityExperienceReplay(
+                buffer_size=self.replay_memory_size,
+                embedding_dim=self.embedding_dim,
+                obs_size=1 + self.state_size + self.n_groups,
+                device=self.device,
+                n_shards=n_actors,
+                n_step=self.n_step,
+                gamma=self.discount_factor,
+            )
+        elif buffer_path:
+            self.buffer = DiskPriorityExperienceReplay(
+                path=buffer_path,
+                buffer_size=self.replay_memory_size,
+                embedding_dim=self.embedding_dim,
+                obs_size=1 + self.state_size + self.n_groups,
+                device=self.device,
+                n_step=self.n_step,
+                gamma=self.discount_factor,
+            )
+        elif compact_buffer:
+            self.buffer = CompactPriorityExperienceReplay(
+                buffer_size=self.replay_memory_size,
+                embedding_dim=self.embedding_dim,
+                state_size=self.state_size,
+                n_groups=self.n_groups,
+                device=self.device,
+                n_step=self.n_step,
+                gamma=self.discount_factor,
+            )
+        else:
+            self.buffer = PriorityExperienceReplay(
+                buffer_size=self.replay_memory_size,
+                embedding_dim=self.embedding_dim,
+                obs_size=1 + self.state_size + self.n_groups,
+                device=self.device,
+                n_step=self.n_step,
+                gamma=self.discount_factor,
+            )
         self.epsilon_for_priority = 1e-6
 
         # noise
         self.noise = OUNoise(self.embedding_dim, decay_period=10)
 
+        # availability mask of the items, see get_available_mask
+        self.masked_items = []
+        self.pending_items = np.empty((0, 0), dtype=np.int64)
+
         self.is_test = False
 
         # wandb
         self.use_wandb = use_wandb
         if use_wandb:
+            if wandb is None:
+                raise ImportError("wandb is required to log the training.")
             wandb.init(
                 project=train_version,
                 config={
@@ -169,32 +254,118 @@ class DRRAgent:
                     "group_fairness": n_groups,
                     "fairness_constraints": self.fairness_constraints,
                     "reward_model": use_reward_model,
+                    "compact_buffer": compact_buffer,
+                    "disk_buffer": bool(buffer_path),
+                    "n_step": self.n_step,
+                    "sequence_length": self.sequence_length,
+                    "n_actors": self.n_actors,
+                    "n_envs": self.n_envs,
+                    "reward_cache_mb": reward_cache_mb,
                 },
             )
 
     def calculate_td_target(self, rewards, q_values, dones):
-        return rewards + ((1 - dones.long()) * (self.discount_factor * q_values))
+        # the buffer stores n-step returns, so bootstrap n steps ahead
+        return rewards + (
+            (1 - dones.long()) * ((self.discount_factor**self.n_step) * q_values)
+        )
 
     def recommend_item(self, action, recommended_items, top_k=False, items_ids=None):
-        if items_ids == None:
-            items_ids = list(set(i for i in range(self.items_num)) - recommended_items)
+        if items_ids is None:
+            return self.recommend_items(action, [recommended_items], top_k=top_k)[0]
 
+        action = action.reshape(-1).float()
         items_ids = np.array(items_ids)
         with torch.no_grad():
-            items_ebs = self.get_items_emb(items_ids)
-        action = torch.transpose(action, 1, 0).float()
+            scores = torch.matmul(self.get_items_emb(items_ids), action)
 
         if top_k:
-            item_indice = torch.argsort(
-                torch.transpose(torch.matmul(items_ebs, action), 1, 0)
-            )[0][-top_k:]
-            return items_ids[item_indice.detach().cpu().numpy()]
+            # ascending order, as the top_k last items of a full sort
+            item_indice = torch.topk(scores, top_k).indices.flip(0).cpu().numpy()
         else:
-            item_idx = torch.argmax(torch.matmul(items_ebs, action))
-            return items_ids[item_idx]
+            item_indice = int(torch.argmax(scores))
+        return items_ids[item_indice]
+
+    def recommend_items(self, actions, recommended_items, top_k=False):
+        """Batched `recommend_item` over the rows of `actions`, with one mask
+        of already recommended items per row."""
+
+        n_rows = len(recommended_items)
+        with torch.no_grad():
+            # score every item and mask out the recommended ones
+            scores = torch.matmul(
+                actions.reshape(n_rows, -1).float(), self.item_embeddings.T
+            )
+            scores = scores.masked_fill(
+                ~self.get_available_mask(recommended_items), -np.inf
+            )
+
+        if top_k:
+            # ascending order, as the top_k last items of a full sort
+            item_indice = torch.topk(scores, top_k).indices.flip(1).cpu().numpy()
+        else:
+            item_indice = torch.argmax(scores, dim=1).cpu().numpy()
+
+        self.pending_items = item_indice.reshape(n_rows, -1)
+        return item_indice
+
+    def get_available_mask(self, recommended_items):
+        """Device mask of the items that are not set in each boolean mask of
+        `recommended_items` (see `OfflineEnv.get_recommended_items`), one row
+        per mask.
+
+        The mask is kept between steps. Within an episode the environment
+        only adds items recommended by the agent, so only those are masked
+        out. A row is rebuilt when a new mask is given (a new episode) or
+        when the counts of recommended items do not match.
+        """
+
+        n_rows = len(recommended_items)
+        if len(self.masked_items) != n_rows:
+            self.masked_items = [None] * n_rows
+            self.n_masked = np.zeros(n_rows, dtype=np.int64)
+            self.available_items = np.ones((n_rows, self.items_num), dtype=bool)
+            self.available_mask = torch.ones(
+                (n_rows, self.items_num), dtype=torch.bool, device=self.device
+            )
+            self.pending_items = np.empty((n_rows, 0), dtype=np.int64)
+
+        rows, new_items = [], []
+        for row, items in enumerate(recommended_items):
+            if items is self.masked_items[row]:
+                for item in self.pending_items[row]:
+                    if items[item] and self.available_items[row, item]:
+                        self.available_items[row, item] = False
+                        rows.append(row)
+                        new_items.append(item)
+                        self.n_masked[row] += 1
+
+            n_items = np.count_nonzero(items)
+            if items is not self.masked_items[row] or self.n_masked[row] != n_items:
+                self.available_items[row] = True
+                np.logical_not(items, out=self.available_items[row, : len(items)])
+                self.available_mask[row] = torch.from_numpy(
+                    self.available_items[row]
+                ).to(self.device)
+                self.masked_items[row] = items
+                self.n_masked[row] = n_items
+
+        if rows:
+            self.available_mask[rows, new_items] = False
+        self.pending_items = np.empty((n_rows, 0), dtype=np.int64)
+
+        return self.available_mask
+
+    def to_index(self, ids):
+        """Index tensor on the agent device. Device tensors are used as is,
+        so batches sampled from the buffer never go through the host."""
+
+        if torch.is_tensor(ids):
+            return ids.to(device=self.device, dtype=torch.long)
+        return torch.as_tensor(np.asarray(ids), dtype=torch.long, device=self.device)
 
     def get_items_emb(self, items_ids):
-        items_eb = self.item_embeddings[items_ids]
+        items_eb = self.item_embeddings[self.to_index(items_ids)]
 
         return items_eb
 
@@ -213,7 +384,7 @@ class DRRAgent:
         ## SRM state
         state = self.srm.network(
             [
-                self.user_embeddings[user_id],
+                self.user_embeddings[self.to_index(user_id)],
                 items_emb.unsqueeze(0) if len(items_emb.shape) < 3 else items_emb,
                 context_emb,
             ]
@@ -221,45 +392,124 @@ class DRRAgent:
 
         return state
 
+    def load_last_checkpoint(self, learner_state=False):
+        """Load the last actor, critic and SRM checkpoints in model_path.
+
+        The state dicts are cached by the checkpoint manager, so loading the
+        same checkpoint again does not read it from disk. With
+        `learner_state`, the whole learner state saved by save_checkpoint is
+        restored, when the last checkpoint holds it.
+        """
+
+        if learner_state:
+            checkpoint = self.checkpoints.open(map_location=self.device)
+            if checkpoint is not None:
+                self.load_learner_state(checkpoint)
+                return
+
+        state_dicts = self.checkpoints.load_state_dicts(map_location=self.device)
+        self.actor.network.load_state_dict(state_dicts["actor"])
+        self.critic.network.load_state_dict(state_dicts["critic"])
+        self.srm.network.load_state_dict(state_dicts["srm"])
+
+    def save_checkpoint(self, step):
+        """Save the learner state as the checkpoint of `step` in model_path.
+
+        The state is copied right away and written to a single file on a
+        background thread, so training goes on while it is saved.
+        """
+
+        if isinstance(self.buffer, DiskPriorityExperienceReplay):
+            self.buffer.checkpoint()
+        self.checkpoints.save(step, self.learner_state())
+
+    def learner_state(self):
+        """Networks, target networks, optimizers, OU noise, replay buffer
+        cursor and random number generator states of the agent."""
+
+        state = {
+            "actor": {
+                "network": self.actor.network.state_dict(),
+                "target_network": self.actor.target_network.state_dict(),
+                "optimizer": self.actor.optimizer.state_dict(),
+            },
+            "critic": {
+                "network": self.critic.network.state_dict(),
+                "target_network": self.critic.target_network.state_dict(),
+                "optimizer": self.critic.optimizer.state_dict(),
+            },
+            "srm": {
+                "network": self.srm.network.state_dict(),
+                "optimizer": self.srm.optimizer.state_dict(),
+            },
+            "noise": {"state": self.noise.state, "sigma": self.noise.sigma},
+            "buffer": {
+                "crt_idx": int(self.buffer.crt_idx),
+                "is_full": bool(self.buffer.is_full),
+                "max_priority": float(self.buffer.max_priority),
+            },
+            "rng": {
+                "python": random.getstate(),
+                "numpy": np.random.get_state(),
+                "torch": torch.get_rng_state(),
+            },
+        }
+        if torch.cuda.is_available():
+            state["rng"]["cuda"] = torch.cuda.get_rng_state_all()
+        return state
+
+    def load_learner_state(self, checkpoint):
+        """Restore the learner state of a checkpoint saved by save_checkpoint.
+
+        The replay buffer cursor is not restored: the disk buffer restores
+        its cursor along with its stored transitions, and the other buffers
+        are not part of the checkpoint.
+        """
+
+        for name in ("actor", "critic"):
+            model = getattr(self, name)
+            model.network.load_state_dict(checkpoint.load(name, "network"))
+            model.target_network.load_state_dict(
+                checkpoint.load(name, "target_network")
+            )
+            model.optimizer.load_state_dict(checkpoint.load(name, "optimizer"))
+        self.srm.network.load_state_dict(checkpoint.load("srm", "network"))
+        self.srm.optimizer.load_state_dict(checkpoint.load("srm", "optimizer"))
+
+        noise = checkpoint.load("noise")
+        self.noise.state = noise["state"]
+        self.noise.sigma = noise["sigma"]
+
+        rng = checkpoint.load("rng")
+        random.setstate(rng["python"])
+        np.random.set_state(rng["numpy"])
+        torch.set_rng_state(rng["torch"].cpu())
+        if "cuda" in rng and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([s.cpu() for s in rng["cuda"]])
+
     def train(self, max_episode_num, top_k=False, load_model=False):
         self.actor.update_target_network()
         self.critic.update_target_network()
 
         if load_model:
-            # Get list of checkpoints
-            actor_checkpoint = sorted(
-                [
-                    int((f.split("_")[1]).split(".")[0])
-                    for f in os.listdir(self.model_path)
-                    if f.startswith("actor_")
-                ]
-            )[-1]
-            critic_checkpoint = sorted(
-                [
-                    int((f.split("_")[1]).split(".")[0])
-                    for f in os.listdir(self.model_path)
-                    if f.startswith("critic_")
-                ]
-            )[-1]
-            srm_checkpoint = sorted(
-                [
-                    int((f.split("_")[1]).split(".")[0])
-                    for f in os.listdir(self.model_path)
-                    if f.startswith("srm_")
-                ]
-            )[-1]
-
-            self.load_model(
-                os.path.join(self.model_path, "actor_{}.h5".format(actor_checkpoint)),
-                os.path.join(self.model_path, "critic_{}.h5".format(critic_checkpoint)),
-                os.path.join(self.model_path, "srm_{}.h5".format(srm_checkpoint)),
-            )
+            self.load_last_checkpoint(learner_state=True)
+        elif isinstance(self.buffer, DiskPriorityExperienceReplay):
+            # only continue from the stored transitions when resuming a training
+            self.buffer.clear()
 
         sum_precision = 0
         sum_ndcg = 0
         sum_propfair = 0
         sum_reward = 0
 
+        actors = self.start_actors(top_k) if self.n_actors > 1 else []
+
+        if self.n_envs > 1:
+            results = self.train_vectorized(max_episode_num, top_k)
+            self.stop_actors(actors)
+            self.checkpoints.wait()
+            return results
+
         for episode in tqdm(range(max_episode_num)):
             # episodic reward
             episode_reward = 0
@@ -291,13 +541,13 @@ class DRRAgent:
 
                 ## ou exploration
                 # if not self.is_test:
-                action = self.noise.get_action(
-                    action.detach().cpu().numpy()[0], steps
-                ).to(self.device)
+                action = self.noise.get_action(action.detach().cpu().numpy()[0], steps)
 
                 ## item
                 recommended_item = self.recommend_item(
-                    action, self.env.get_recommended_items(), top_k=top_k
+                    action.to(self.device),
+                    self.env.get_recommended_items(),
+                    top_k=top_k,
                 )
                 list_recommended_item.append(recommended_item)
 
@@ -312,30 +562,18 @@ class DRRAgent:
                 next_group_counts = self.env.get_group_count()
 
                 # experience replay
-                self.buffer.append(
-                    # state
-                    torch.Tensor(
-                        np.concatenate(([user_id], items_ids, group_counts), axis=0)
-                    ).to(self.device),
-                    # action
-                    action,
-                    # reward
-                    (
-                        torch.FloatTensor([np.sum(reward)]).to(self.device)
-                        if top_k
-                        else torch.FloatTensor([reward]).to(self.device)
-                    ),
-                    # next_state
-                    torch.Tensor(
-                        np.concatenate(
-                            ([user_id], next_items_ids, next_group_counts), axis=0
-                        )
-                    ).to(self.device),
-                    # done
-                    torch.Tensor([done]).to(self.device),
+                self.buffer.append_step(
+                    user_id,
+                    items_ids,
+                    group_counts,
+                    action[0].numpy(),
+                    np.sum(reward) if top_k else reward,
+                    next_items_ids,
+                    next_group_counts,
+                    done,
                 )
 
-                if self.buffer.crt_idx > self.learning_starts or self.buffer.is_full:
+                if len(self.buffer) > self.learning_starts or self.buffer.is_full:
                     _critic_loss, _actor_loss = self.update_model()
                     actor_loss += _actor_loss
                     critic_loss += _critic_loss
@@ -384,8 +622,8 @@ class DRRAgent:
                                 "precision": (mean_precision / steps) * 100,
                                 "ndcg": mean_ndcg / steps,
                                 "total_reward": episode_reward,
-                                "critic_loss": critic_loss / steps,
-                                "actor_loss": actor_loss / steps,
+                                "critic_loss": float(critic_loss) / steps,
+                                "actor_loss": float(actor_loss) / steps,
                                 "mean_action": mean_action / steps,
                                 "propfair": propfair,
                                 "cvr": mean_precision / steps,
@@ -395,11 +633,10 @@ class DRRAgent:
                         )
 
             if (episode + 1) % 1000 == 0:
-                self.save_model(
-                    os.path.join(self.model_path, "actor_{}.h5".format(episode + 1)),
-                    os.path.join(self.model_path, "critic_{}.h5".format(episode + 1)),
-                    os.path.join(self.model_path, "srm_{}.h5".format(episode + 1)),
-                )
+                self.save_checkpoint(episode + 1)
+
+        self.stop_actors(actors)
+        self.checkpoints.wait()
 
         return (
             sum_precision / max_episode_num,
@@ -409,6 +646,351 @@ class DRRAgent:
             {user_id: list_recommended_item},
         )
 
+    def train_vectorized(self, max_episode_num, top_k=False):
+        """Training loop over `n_envs` environments run in lockstep.
+
+        States, actions and recommended items are computed for all the
+        environments at once, every transition is stored, and the model is
+        updated once per lockstep. Finished episodes are reset by the
+        vector environment and logged as in `train`.
+        """
+
+        env = VectorOfflineEnv.from_env(self.env, self.n_envs)
+        noises = [
+            OUNoise(self.embedding_dim, decay_period=10) for _ in range(self.n_envs)
+        ]
+
+        sum_precision = 0
+        sum_ndcg = 0
+        sum_propfair = 0
+        sum_reward = 0
+
+        # per environment episode statistics
+        steps = np.zeros(self.n_envs, dtype=np.int64)
+        episode_reward = np.zeros(self.n_envs)
+        mean_action = np.zeros(self.n_envs)
+        mean_precision = np.zeros(self.n_envs)
+        mean_ndcg = np.zeros(self.n_envs)
+        critic_loss = torch.zeros(self.n_envs, device=self.device)
+        actor_loss = torch.zeros(self.n_envs, device=self.device)
+        list_recommended_item = [[] for _ in range(self.n_envs)]
+
+        env.reset()
+        episode = 0
+        progress = tqdm(total=max_episode_num)
+        while episode < max_episode_num:
+            # copies: stepping overwrites the observations of the vector env
+            users = env.users.copy()
+            items_ids = [list(items) for items in env.items]
+            group_counts = env.get_group_count()
+
+            with torch.no_grad():
+                state = self.get_state(users, np.array(items_ids), group_counts)
+                action = self.actor.network(state).cpu().numpy()
+
+            ## ou exploration
+            action = np.concatenate(
+                [
+                    noise.get_action(a, int(t)).numpy()
+                    for noise, a, t in zip(noises, action, steps)
+                ]
+            )
+
+            recommended_items = self.recommend_items(
+                torch.from_numpy(action).to(self.device),
+                env.get_recommended_items(),
+                top_k=top_k,
+            )
+            next_items_ids, rewards, dones, infos = env.step(
+                recommended_items, top_k=top_k
+            )
+
+            for i in range(self.n_envs):
+                reward = np.sum(rewards[i]) if top_k else rewards[i]
+                self.buffer.append_step(
+                    users[i],
+                    items_ids[i],
+                    group_counts[i],
+                    action[i],
+                    reward,
+                    next_items_ids[i],
+                    infos[i]["group_count"],
+                    dones[i],
+                )
+                list_recommended_item[i].append(recommended_items[i])
+                episode_reward[i] += reward
+                mean_action[i] += np.mean(action[i])
+
+                if top_k:
+                    correct_list = infos[i]["precision"]
+                    dcg, idcg = self.calculate_ndcg(
+                        correct_list, [1 for _ in range(len(correct_list))]
+                    )
+                    mean_ndcg[i] += dcg / idcg
+                    mean_precision[i] += (top_k - correct_list.count(0)) / top_k
+                else:
+                    mean_precision[i] += infos[i]["precision"]
+            steps += 1
+
+            if len(self.buffer) > self.learning_starts or self.buffer.is_full:
+                _critic_loss, _actor_loss = self.update_model()
+                actor_loss += _actor_loss
+                critic_loss += _critic_loss
+
+            for i in np.flatnonzero(dones):
+                propfair = 0
+                group_count = np.array(infos[i]["group_count"])
+                total_exp = np.sum(group_count)
+                if total_exp > 0:
+                    propfair = np.sum(
+                        np.array(self.fairness_constraints)
+                        * np.log(1 + group_count / total_exp)
+                    )
+
+                precision = mean_precision[i] / steps[i]
+                sum_precision += precision
+                sum_ndcg += mean_ndcg[i] / steps[i]
+                sum_propfair += propfair
+                sum_reward += episode_reward[i]
+
+                if self.use_wandb:
+                    wandb.log(
+                        {
+                            "precision": precision * 100,
+                            "ndcg": mean_ndcg[i] / steps[i],
+                            "total_reward": episode_reward[i],
+                            "critic_loss": critic_loss[i].item() / steps[i],
+                            "actor_loss": actor_loss[i].item() / steps[i],
+                            "mean_action": mean_action[i] / steps[i],
+                            "propfair": propfair,
+                            "cvr": precision,
+                            "ufg": propfair / max(1 - precision, 0.01),
+                        }
+                    )
+
+                user_id, last_recommended_items = users[i], list_recommended_item[i]
+                noises[i].reset()
+                for stat in (
+                    steps,
+                    episode_reward,
+                    mean_action,
+                    mean_precision,
+                    mean_ndcg,
+                    critic_loss,
+                    actor_loss,
+                ):
+                    stat[i] = 0
+                list_recommended_item[i] = []
+
+                episode += 1
+                progress.update(1)
+                if episode % 1000 == 0:
+                    self.save_checkpoint(episode)
+                if episode == max_episode_num:
+                    break
+        progress.close()
+
+        return (
+            sum_precision / max_episode_num,
+            sum_ndcg / max_episode_num,
+            sum_propfair / max_episode_num,
+            sum_reward / max_episode_num,
+            {user_id: last_recommended_items},
+        )
+
+    def start_actors(self, top_k=False):
+        """Fork `n_actors - 1` processes that collect episodes into their own
+        buffer shard while this process keeps learning on shard 0. The
+        policy parameters are moved to shared memory, so the actors always
+        act with the latest weights."""
+
+        self.actor.network.share_memory()
+        self.srm.network.share_memory()
+
+        ctx = multiprocessing.get_context("fork")
+        self.stop_event = ctx.Event()
+        seeds = np.random.randint(2**31, size=self.n_actors - 1)
+        actors = [
+            ctx.Process(
+                target=self.collect,
+                args=(shard_id, seed, top_k),
+                daemon=True,
+            )
+            for shard_id, seed in zip(range(1, self.n_actors), seeds)
+        ]
+        for actor in actors:
+            actor.start()
+
+        return actors
+
+    def stop_actors(self, actors):
+        if not actors:
+            return
+
+        self.stop_event.set()
+        for actor in actors:
+            actor.join()
+
+    def evaluate_users(self, users, make_env, top_k=False, n_workers=1, batch_size=1):
+        """Evaluate the current weights on each user of `users`.
+
+        Users are evaluated read-only (see `learn` in online_evaluate), so
+        they are independent of each other: they are split into `n_workers`
+        contiguous shards, evaluated by forked processes that share the
+        weights of this process, and the results are merged back in the
+        order of `users`.
+
+        Parameters
+        ----------
+        users: list
+            Ids of the users to evaluate.
+        make_env: callable
+            Builds the evaluation environment of a user id.
+        top_k: bool or int
+            Passed to online_evaluate.
+        n_workers: int
+            Number of processes. Evaluation runs in this process if 1, or
+            on CUDA devices.
+        batch_size: int
+            If greater than 1, the users of each shard are evaluated in
+            lockstep batches of this size (see evaluate_batch).
+
+        Returns
+        -------
+        results: list
+            Result of online_evaluate for each user.
+        """
+
+        users = list(users)
+        n_workers = max(1, min(n_workers, len(users)))
+        if n_workers == 1 or self.device.type == "cuda":
+            return self.evaluate_shard(users, make_env, top_k, batch_size)
+
+        ctx = multiprocessing.get_context("fork")
+        queue = ctx.Queue()
+        shards = np.array_split(np.arange(len(users)), n_workers)
+        workers = [
+            ctx.Process(
+                target=self.evaluate_worker,
+                args=(
+                    shard_id,
+                    [users[i] for i in shard],
+                    make_env,
+                    top_k,
+                    batch_size,
+                    queue,
+                ),
+                daemon=True,
+            )
+            for shard_id, shard in enumerate(shards)
+        ]
+        for worker in workers:
+            worker.start()
+
+        # drain the queue before joining, workers block until it is read
+        results = {}
+        for _ in workers:
+            shard_id, shard_results = queue.get()
+            if isinstance(shard_results, Exception):
+                for worker in workers:
+                    worker.terminate()
+                raise shard_results
+            results[shard_id] = shard_results
+        for worker in workers:
+            worker.join()
+
+        return [result for shard_id in range(n_workers) for result in results[shard_id]]
+
+    def evaluate_shard(self, users, make_env, top_k=False, batch_size=1):
+        if batch_size <= 1:
+            return [
+                self.online_evaluate(make_env(user_id), top_k=top_k, learn=False)
+                for user_id in users
+            ]
+
+        results = []
+        for start in range(0, len(users), batch_size):
+            envs = [make_env(user_id) for user_id in users[start : start + batch_size]]
+            results.extend(self.evaluate_batch(envs, top_k=top_k))
+        return results
+
+    def evaluate_worker(self, shard_id, users, make_env, top_k, batch_size, queue):
+        """Evaluation loop of a worker process."""
+
+        torch.set_num_threads(1)
+        try:
+            results = self.evaluate_shard(users, make_env, top_k, batch_size)
+            queue.put((shard_id, results))
+        except Exception:
+            queue.put(
+                (
+                    shard_id,
+                    RuntimeError(
+                        "Evaluation of shard {} failed:\n{}".format(
+                            shard_id, traceback.format_exc()
+                        )
+                    ),
+                )
+            )
+
+    def collect(self, shard_id, seed, top_k=False):
+        """Exploration loop of an actor process."""
+
+        torch.set_num_threads(1)
+        np.random.seed(seed)
+        self.buffer.set_shard(shard_id)
+
+        while not self.stop_event.is_set():
+            user_id, items_ids, done = self.env.reset()
+            self.noise.reset()
+            steps = 0
+
+            while not done:
+                with torch.no_grad():
+                    group_counts = self.env.get_group_count()
+                    state = self.get_state(
+                        np.array([user_id]),
+                        np.array([items_ids]),
+                        np.array([group_counts]),
+                    )
+                    action = self.actor.network(state)
+
+                action = self.noise.get_action(action.cpu().numpy()[0], steps)
+                recommended_item = self.recommend_item(
+                    action.to(self.device),
+                    self.env.get_recommended_items(),
+                    top_k=top_k,
+                )
+                next_items_ids, reward, done, _ = self.env.step(
+                    recommended_item, top_k=top_k
+                )
+
+                self.buffer.append_step(
+                    user_id,
+                    items_ids,
+                    group_counts,
+                    action[0].numpy(),
+                    np.sum(reward) if top_k else reward,
+                    next_items_ids,
+                    self.env.get_group_count(),
+                    done,
+                )
+
+                items_ids = next_items_ids
+                steps += 1
+
+        self.buffer.flush()
+
+    def sample_batch(self):
+        if self.sequence_length == 1:
+            return self.buffer.sample(self.batch_size)
+
+        # contiguous sequences within episodes, flattened into one batch
+        *batch, index_batch = self.buffer.sample_sequences(
+            max(1, self.batch_size // self.sequence_length), self.sequence_length
+        )
+        return (*(t.flatten(0, 1) for t in batch), index_batch.reshape(-1))
+
     def update_model(self):
         # sample a minibatch
         (
@@ -419,65 +1001,46 @@ class DRRAgent:
             batch_dones,
             weight_batch,
             index_batch,
-        ) = self.buffer.sample(self.batch_size)
-
-        states = self.get_state(
-            batch_states[:, 0].long().detach().cpu().numpy(),  # user_id
-            batch_states[:, 1 : self.state_size + 1]
-            .long()
-            .detach()
-            .cpu()
-            .numpy(),  # items_ids
-            batch_states[:, self.state_size + 1 :]
-            .long()
-            .detach()
-            .cpu()
-            .numpy(),  # group_counts
-        )
-        actions = self.actor.network(states)
+        ) = self.sample_batch()
 
-        policy_loss = self.critic.network(
-            [
-                actions,
-                states,
-            ]
+        # Estimate target Q value, no gradient flows through the targets
+        with torch.no_grad():
+            next_states = self.get_state(
+                batch_next_states[:, 0].long(),
+                batch_next_states[:, 1 : self.state_size + 1].long(),
+                batch_next_states[:, self.state_size + 1 :].long(),
+            )
+            target_next_action = self.actor.target_network(next_states)
+            target_qs = self.critic.target_network([target_next_action, next_states])
+            qs = self.critic.network([target_next_action, next_states])
+
+            min_qs = torch.min(target_qs, qs).squeeze(1)  # Double Q method
+
+            # set TD targets
+            td_targets = self.calculate_td_target(
+                batch_rewards,
+                min_qs,
+                batch_dones,
+            ).unsqueeze(1)
+
+        # update priority: the one device-to-host copy of the learner step,
+        # since the priority tree lives on the host
+        priorities = (
+            (td_targets.abs().squeeze(1) + self.epsilon_for_priority).cpu().numpy()
         )
-        policy_loss = -policy_loss.mean()
+        self.buffer.update_priorities(priorities, index_batch)
 
-        # Estimate target Q value
-        next_states = self.get_state(
-            batch_next_states[:, 0].long().detach().cpu().numpy(),
-            batch_next_states[:, 1 : self.state_size + 1].long().detach().cpu().numpy(),
-            batch_next_states[:, self.state_size + 1 :].long().detach().cpu().numpy(),
-        )
-        target_next_action = self.actor.target_network(next_states)
-        target_qs = self.critic.target_network(
-            [
-                target_next_action.detach(),
-                next_states,
-            ]
-        )
-        qs = self.critic.network(
-            [
-                target_next_action.detach(),
-                next_states,
-            ]
+        states = self.get_state(
+            batch_states[:, 0].long(),  # user_id
+            batch_states[:, 1 : self.state_size + 1].long(),  # items_ids
+            batch_states[:, self.state_size + 1 :].long(),  # group_counts
         )
 
-        min_qs = torch.min(torch.cat([target_qs, qs], axis=1), 1, True).values.squeeze(
-            1
-        )  # Double Q method
-
-        # set TD targets
-        td_targets = self.calculate_td_target(
-            batch_rewards,
-            min_qs,
-            batch_dones,
-        ).unsqueeze(1)
-
-        # update priority
-        for p, i in zip(td_targets, index_batch):
-            self.buffer.update_priority(abs(p[0]) + self.epsilon_for_priority, i)
+        # the policy loss only trains the actor (and the SRM), so the critic
+        # is frozen for its forward pass
+        self.critic.network.requires_grad_(False)
+        policy_loss = -self.critic.network([self.actor.network(states), states]).mean()
+        self.critic.network.requires_grad_(True)
 
         # get Q values for current state
         value = self.critic.network(
@@ -489,15 +1052,13 @@ class DRRAgent:
         value_loss = self.critic.loss(value, td_targets)
         value_loss = torch.mean(value_loss * weight_batch)
 
-        # update actor network
+        # one backward pass: the actor gets the policy gradient, the critic the
+        # value gradient and the SRM the sum of both
         self.srm.optimizer.zero_grad()
         self.actor.optimizer.zero_grad()
-        policy_loss.backward(retain_graph=True)
-        self.actor.optimizer.step()
-
-        # update critic network
         self.critic.optimizer.zero_grad()
-        value_loss.backward(retain_graph=True)
+        (policy_loss + value_loss).backward()
+        self.actor.optimizer.step()
         self.critic.optimizer.step()
         self.srm.optimizer.step()
 
@@ -505,39 +1066,15 @@ class DRRAgent:
         self.actor.update_target_network()
         self.critic.update_target_network()
 
-        return value_loss.detach().cpu().numpy(), policy_loss.detach().cpu().numpy()
+        # the losses stay on the device, callers read them once per episode
+        return value_loss.detach(), policy_loss.detach()
 
-    def online_evaluate(self, env, top_k=False, available_items=None, load_model=False):
+    def online_evaluate(
+        self, env, top_k=False, available_items=None, load_model=False, learn=True
+    ):
         env.item_embeddings = self.item_embeddings
         if load_model:
-            # Get list of checkpoints
-            actor_checkpoint = sorted(
-                [
-                    int((f.split("_")[1]).split(".")[0])
-                    for f in os.listdir(self.model_path)
-                    if f.startswith("actor_")
-                ]
-            )[-1]
-            critic_checkpoint = sorted(
-                [
-                    int((f.split("_")[1]).split(".")[0])
-                    for f in os.listdir(self.model_path)
-                    if f.startswith("critic_")
-                ]
-            )[-1]
-            srm_checkpoint = sorted(
-                [
-                    int((f.split("_")[1]).split(".")[0])
-                    for f in os.listdir(self.model_path)
-                    if f.startswith("srm_")
-                ]
-            )[-1]
-
-            self.load_model(
-                os.path.join(self.model_path, "actor_{}.h5".format(actor_checkpoint)),
-                os.path.join(self.model_path, "critic_{}.h5".format(critic_checkpoint)),
-                os.path.join(self.model_path, "srm_{}.h5".format(srm_checkpoint)),
-            )
+            self.load_last_checkpoint()
 
         steps = 0
         mean_precision = 0
@@ -612,29 +1149,23 @@ class DRRAgent:
             # next_state = self.get_state([user_id], [[next_items_ids]])
             next_group_counts = env.get_group_count()
 
-            # experience replay
-            self.buffer.append(
-                torch.Tensor(
-                    np.concatenate(([user_id], items_ids, group_counts), axis=0)
-                ).to(self.device),
-                action,
-                (
-                    torch.FloatTensor([np.sum(reward)]).to(self.device)
-                    if top_k
-                    else torch.FloatTensor([reward]).to(self.device)
-                ),
-                torch.Tensor(
-                    np.concatenate(
-                        ([user_id], next_items_ids, next_group_counts), axis=0
-                    )
-                ).to(self.device),
-                torch.Tensor([done]).to(self.device),
-            )
+            # experience replay, unless the weights are evaluated read-only
+            if learn:
+                self.buffer.append_step(
+                    user_id,
+                    items_ids,
+                    group_counts,
+                    buffer_actions[-1],
+                    np.sum(reward) if top_k else reward,
+                    next_items_ids,
+                    next_group_counts,
+                    done,
+                )
 
-            if self.buffer.crt_idx > self.learning_starts or self.buffer.is_full:
-                _critic_loss, _actor_loss = self.update_model()
-                actor_loss += _actor_loss
-                critic_loss += _critic_loss
+                if len(self.buffer) > self.learning_starts or self.buffer.is_full:
+                    _critic_loss, _actor_loss = self.update_model()
+                    actor_loss += _actor_loss
+                    critic_loss += _critic_loss
 
             items_ids = next_items_ids
             episode_reward += np.sum(reward) if top_k else reward
@@ -679,8 +1210,8 @@ class DRRAgent:
             "reward_list": buffer_reward,
             "recommended_items": {user_id: list_recommended_item},
             "exposure": (np.array(env.get_group_count()) / total_exp).tolist(),
-            "critic_loss": critic_loss / steps,
-            "actor_loss": actor_loss / steps,
+            "critic_loss": float(critic_loss) / steps,
+            "actor_loss": float(actor_loss) / steps,
             "user_id": user_id,
             "user_states": buffer_states,
             "user_intent": buffer_intent,
@@ -690,6 +1221,117 @@ class DRRAgent:
             "fairness": buffer_fairness,
         }
 
+    def evaluate_batch(self, envs, top_k=False):
+        """Evaluate the current weights on the users of `envs` in lockstep.
+
+        Pure inference version of online_evaluate: every step runs one
+        batched SRM/actor forward for all the unfinished episodes and picks
+        their items with a masked top k, with no buffer writes or gradient
+        steps. Returns the result of online_evaluate for each environment.
+        """
+
+        n_envs = len(envs)
+        results = [
+            {
+                "precision": 0,
+                "precision_list": [],
+                "reward": 0,
+                "reward_list": [],
+                "critic_loss": 0.0,
+                "actor_loss": 0.0,
+                "user_states": [],
+                "user_intent": [],
+                "user_action_rank": [],
+                "user_propfair": [],
+                "relevance": [],
+                "fairness": [],
+            }
+            for _ in range(n_envs)
+        ]
+        recommended_items = [[] for _ in range(n_envs)]
+        steps = np.zeros(n_envs, dtype=np.int64)
+
+        users = np.zeros(n_envs, dtype=np.int64)
+        items_ids = [None] * n_envs
+        for i, env in enumerate(envs):
+            env.item_embeddings = self.item_embeddings
+            users[i], items_ids[i], _ = env.reset()
+
+        active = np.arange(n_envs)
+        while len(active):
+            with torch.no_grad():
+                states = self.get_state(
+                    users[active],
+                    np.array([items_ids[i] for i in active]),
+                    np.array([envs[i].get_group_count() for i in active]),
+                )
+                actions = self.actor.network(states)
+
+                recommended = self.recommend_items(
+                    actions,
+                    [envs[i].get_recommended_items() for i in active],
+                    top_k=top_k,
+                )
+            states = states.cpu().numpy()
+            actions = actions.cpu().numpy()
+
+            done = np.zeros(len(active), dtype=bool)
+            for row, i in enumerate(active):
+                env, result = envs[i], results[i]
+                result["user_states"].append(states[row : row + 1].tolist())
+                result["user_action_rank"].append(actions[row].tolist())
+                if self.track_user_intent:
+                    result["user_intent"].append(env._get_user_intent().tolist())
+
+                recommended_item = recommended[row]
+                recommended_items[i].extend(
+                    list([recommended_item] if not top_k else recommended_item)
+                )
+
+                items_ids[i], reward, done[row], info = env.step(
+                    recommended_item, top_k=top_k
+                )
+                result["user_propfair"].append(
+                    self.calculate_propfair(env.get_group_count())
+                )
+
+                reward = np.sum(reward) if top_k else reward
+                result["reward"] += reward
+                steps[i] += 1
+
+                if top_k:
+                    correct_list = info["precision"]
+                    result["precision"] += (top_k - correct_list.count(0)) / top_k
+                else:
+                    result["precision"] += info["precision"]
+
+                result["relevance"].append(info["relevance"])
+                result["fairness"].append(info["fairness"])
+                result["precision_list"].append(info["precision"])
+                result["reward_list"].append(reward)
+
+            active = active[~done]
+
+        for i, (env, result) in enumerate(zip(envs, results)):
+            group_count = np.array(env.get_group_count())
+            result["precision"] /= steps[i]
+            result["propfair"] = self.calculate_propfair(group_count)
+            result["recommended_items"] = {env.user: recommended_items[i]}
+            result["exposure"] = (group_count / np.sum(group_count)).tolist()
+            result["user_id"] = env.user
+
+        return results
+
+    def calculate_propfair(self, group_count):
+        propfair = 0
+        total_exp = np.sum(group_count)
+        if total_exp > 0:
+            propfair = np.sum(
+                np.array(self.fairness_constraints)
+                * np.log(1 + np.array(group_count) / total_exp)
+            )
+        return propfair
+
     def offline_evaluate(self, env, top_k=0, available_items=None):
         steps = 0
         mean_precision = 0
@@ -770,7 +1412,9 @@ class DRRAgent:
         self.actor.save_weights(actor_path)
         self.critic.save_weights(critic_path)
         self.srm.save_weights(srm_path)
-        if buffer_path:
+        if isinstance(self.buffer, DiskPriorityExperienceReplay):
+            self.buffer.checkpoint()
+        elif buffer_path:
             import pickle
 
             with open(buffer_path, "wb") as f:
@@ -4,12 +4,12 @@ import numpy as np
 import time
 import os
 
-from operator import itemgetter
-
 from src.model.recommender.drr import DRRAgent
 
 
 class FairRecAgent(DRRAgent):
+    track_user_intent = True
+
     def __init__(
         self,
         env,
@@ -38,6 +38,13 @@ class FairRecAgent(DRRAgent):
         fairness_constraints=[0.25, 0.25, 0.25, 0.25],
         no_cuda=False,
         use_reward_model=True,
+        compact_buffer=False,
+        buffer_path=None,
+        n_step=1,
+        sequence_length=1,
+        n_actors=1,
+        n_envs=1,
+        reward_cache_mb=0,
     ):
         super().__init__(
             env=env,
@@ -66,28 +73,43 @@ class FairRecAgent(DRRAgent):
             fairness_constraints=fairness_constraints,
             no_cuda=no_cuda,
             use_reward_model=use_reward_model,
+            compact_buffer=compact_buffer,
+            buffer_path=buffer_path,
+            n_step=n_step,
+            sequence_length=sequence_length,
+            n_actors=n_actors,
+            n_envs=n_envs,
+            reward_cache_mb=reward_cache_mb,
         )
 
-        groups_id = list(self.env.groups_items.keys())
-        groups_items = list(self.env.groups_items.values())
-        self.group_emb = {}
-        for g, items in zip(groups_id, groups_items):
+        # group of each item and mean item embedding of each group (row 0,
+        # items without a group, is zero), so states are gathered on the device
+        item_group = np.zeros(self.items_num, dtype=np.int64)
+        item_group[: len(self.env.item_group)] = self.env.item_group[: self.items_num]
+        self.item_group = torch.from_numpy(item_group).to(self.device)
+
+        self.group_emb = torch.zeros(
+            (self.n_groups + 1, self.embedding_dim), device=self.device
+        )
+        for g, items in self.env.groups_items.items():
             self.group_emb[g] = torch.mean(self.get_items_emb(items), axis=0)
 
     def get_state(self, user_id, items_ids, group_counts):
-        groups = []
-        fairness_allocation = []
-        for batch_item, batch_group in zip(items_ids, group_counts):
-            _groups = list(itemgetter(*batch_item)(self.env.item_groups))
-            groups.append(torch.stack([self.group_emb[g] for g in _groups]))
-
-            total_exp = np.sum(batch_group)
-            _fairness_allocation = (
-                (np.array(batch_group) / total_exp)
-                if total_exp > 0
-                else np.zeros(self.n_groups)
+        items_ids = self.to_index(items_ids)
+        if torch.is_tensor(group_counts):
+            group_counts = group_counts.to(device=self.device, dtype=torch.float32)
+        else:
+            group_counts = torch.as_tensor(
+                np.asarray(group_counts), dtype=torch.float32, device=self.device
             )
-            fairness_allocation.append(_fairness_allocation)
+
+        # exposure of each group, zero while nothing is recommended
+        total_exp = group_counts.sum(dim=-1, keepdim=True)
+        fairness_allocation = torch.where(
+            total_exp > 0,
+            group_counts / total_exp,
+            torch.zeros_like(group_counts),
+        )
 
         # context_emb = (
         #     torch.from_numpy(self.context_emb.get_embedding(items_ids.tolist())).to(
@@ -102,50 +124,23 @@ class FairRecAgent(DRRAgent):
         state = self.srm.network(
             [
                 self.get_items_emb(items_ids),  # batch_size x n_items x embedding_dim
-                torch.stack(groups).to(
-                    self.device
-                ),  # batch_size x n_items x embedding_dim
-                torch.FloatTensor(np.array(fairness_allocation)).to(
-                    self.device
-                ),  # batch_size x n_groups
-                self.user_embeddings[user_id],
+                self.group_emb[
+                    self.item_group[items_ids]
+                ],  # batch_size x n_items x embedding_dim
+                fairness_allocation,  # batch_size x n_groups
+                self.user_embeddings[self.to_index(user_id)],
                 context_emb,
             ]
         )
 
         return state
 
-    def online_evaluate(self, env, top_k=False, available_items=None, load_model=False):
+    def online_evaluate(
+        self, env, top_k=False, available_items=None, load_model=False, learn=True
+    ):
         env.item_embeddings = self.item_embeddings
         if load_model:
-            # Get list of checkpoints
-            actor_checkpoint = sorted(
-                [
-                    int((f.split("_")[1]).split(".")[0])
-                    for f in os.listdir(self.model_path)
-                    if f.startswith("actor_")
-                ]
-            )[-1]
-            critic_checkpoint = sorted(
-                [
-                    int((f.split("_")[1]).split(".")[0])
-                    for f in os.listdir(self.model_path)
-                    if f.startswith("critic_")
-                ]
-            )[-1]
-            srm_checkpoint = sorted(
-                [
-                    int((f.split("_")[1]).split(".")[0])
-                    for f in os.listdir(self.model_path)
-                    if f.startswith("srm_")
-                ]
-            )[-1]
-
-            self.load_model(
-                os.path.join(self.model_path, "actor_{}.h5".format(actor_checkpoint)),
-                os.path.join(self.model_path, "critic_{}.h5".format(critic_checkpoint)),
-                os.path.join(self.model_path, "srm_{}.h5".format(srm_checkpoint)),
-            )
+            self.load_last_checkpoint()
 
         steps = 0
         mean_precision = 0
@@ -221,29 +216,23 @@ class FairRecAgent(DRRAgent):
             # next_state = self.get_state([user_id], [[next_items_ids]])
             next_group_counts = env.get_group_count()
 
-            # experience replay
-            self.buffer.append(
-                torch.Tensor(
-                    np.concatenate(([user_id], items_ids, group_counts), axis=0)
-                ).to(self.device),
-                action,
-                (
-                    torch.FloatTensor([np.sum(reward)]).to(self.device)
-                    if top_k
-                    else torch.FloatTensor([reward]).to(self.device)
-                ),
-                torch.Tensor(
-                    np.concatenate(
-                        ([user_id], next_items_ids, next_group_counts), axis=0
-                    )
-                ).to(self.device),
-                torch.Tensor([done]).to(self.device),
-            )
+            # experience replay, unless the weights are evaluated read-only
+            if learn:
+                self.buffer.append_step(
+                    user_id,
+                    items_ids,
+                    group_counts,
+                    buffer_actions[-1],
+                    np.sum(reward) if top_k else reward,
+                    next_items_ids,
+                    next_group_counts,
+                    done,
+                )
 
-            if self.buffer.crt_idx > self.learning_starts or self.buffer.is_full:
-                _critic_loss, _actor_loss = self.update_model()
-                actor_loss += _actor_loss
-                critic_loss += _critic_loss
+                if len(self.buffer) > self.learning_starts or self.buffer.is_full:
+                    _critic_loss, _actor_loss = self.update_model()
+                    actor_loss += _actor_loss
+                    critic_loss += _critic_loss
 
             items_ids = next_items_ids
             episode_reward += np.sum(reward) if top_k else reward
@@ -288,8 +277,8 @@ class FairRecAgent(DRRAgent):
             "reward_list": buffer_reward,
             "recommended_items": {user_id: list_recommended_item},
             "exposure": (np.array(env.get_group_count()) / total_exp).tolist(),
-            "critic_loss": critic_loss / steps,
-            "actor_loss": actor_loss / steps,
+            "critic_loss": float(critic_loss) / steps,
+            "actor_loss": float(actor_loss) / steps,
             "user_id": user_id,
             "user_states": buffer_states,
             "user_intent": buffer_intent,
@@ -1,12 +1,25 @@
+import os
+import json
+import multiprocessing
 import numpy as np
-from src.model.tree import SumTree, MinTree
-import random
+from src.model.tree import SUM, SegmentTree
 import torch
 
 
 class PriorityExperienceReplay(object):
-    def __init__(self, buffer_size, embedding_dim, obs_size, device):
+    def __init__(
+        self,
+        buffer_size,
+        embedding_dim,
+        obs_size,
+        device,
+        tree_dtype=np.float64,
+        staging_size=256,
+        n_step=1,
+        gamma=0.9,
+    ):
         self.device = device
+        self.storage_device = device
 
         self.buffer_size = buffer_size
         self.crt_idx = 0
@@ -24,73 +37,838 @@ class PriorityExperienceReplay(object):
         )
         self.dones = torch.zeros(buffer_size, dtype=torch.bool).to(device)
 
-        self.sum_tree = SumTree(buffer_size)
-        self.min_tree = MinTree(buffer_size)
+        self.tree = SegmentTree(buffer_size, dtype=tree_dtype)
 
         self.max_priority = 1.0
         self.alpha = 0.6
         self.beta = 0.4
         self.beta_constant = 0.00001
 
+        self._init_staging(staging_size, embedding_dim, obs_size)
+        self._init_n_step(n_step, gamma)
+
+    def _init_n_step(self, n_step, gamma):
+        self.n_step = n_step
+        self.gamma = gamma
+        # transitions of the current episode waiting for their n-step return
+        self.window = []
+
+        # episode of each entry, used to sample sequences within episodes
+        self.episodes = np.zeros(self.buffer_size, dtype=np.int64)
+        self.episode = 0
+
+    def _init_staging(self, staging_size, embedding_dim, obs_size):
+        """Preallocate the host rows written by `append_step`.
+
+        On CUDA the rows live in pinned memory so the chunked flush to the
+        device buffer is a single asynchronous copy per field.
+        """
+
+        pin_memory = torch.device(self.storage_device).type == "cuda"
+
+        # a chunk never holds the same slot twice
+        staging_size = min(staging_size, self.buffer_size)
+        self.staging_size = staging_size
+        self.n_staged = 0
+        self.staged_index = np.zeros(staging_size, dtype=np.int64)
+        self.staging = {
+            "states": torch.zeros((staging_size, obs_size), pin_memory=pin_memory),
+            "actions": torch.zeros(
+                (staging_size, embedding_dim), pin_memory=pin_memory
+            ),
+            "rewards": torch.zeros(staging_size, pin_memory=pin_memory),
+            "next_states": torch.zeros((staging_size, obs_size), pin_memory=pin_memory),
+            "dones": torch.zeros(staging_size, dtype=torch.bool, pin_memory=pin_memory),
+        }
+        # NumPy views of the staging rows, written in place by append_step
+        self.staging_np = {k: v.numpy() for k, v in self.staging.items()}
+        self.flush_event = None
+
     def append(self, state, action, reward, next_state, done):
-        self.states[self.crt_idx] = state
-        self.actions[self.crt_idx] = action
-        self.rewards[self.crt_idx] = reward
-        self.next_states[self.crt_idx] = next_state
-        self.dones[self.crt_idx] = done
+        self.flush()
+        self._store(self.crt_idx, state, action, reward, next_state, done)
+
+        self.tree.update_priority(self.max_priority**self.alpha, self.crt_idx)
+        self._advance(done)
 
-        self.sum_tree.add_data(self.max_priority**self.alpha)
-        self.min_tree.add_data(self.max_priority**self.alpha)
+    def _advance(self, done):
+        self.episodes[self.crt_idx] = self.episode
+        if done:
+            self.episode += 1
 
         self.crt_idx = (self.crt_idx + 1) % self.buffer_size
         if self.crt_idx == 0:
             self.is_full = True
 
+    def append_step(
+        self,
+        user_id,
+        items_ids,
+        group_counts,
+        action,
+        reward,
+        next_items_ids,
+        next_group_counts,
+        done,
+    ):
+        """Append a transition given as raw Python/NumPy values.
+
+        The values are written in place into a preallocated host staging row
+        and flushed to the buffer storage in chunks of `staging_size` rows
+        (or before sampling), so no tensor is allocated per step.
+
+        With `n_step > 1` the transitions of the current episode are held
+        back until their n-step return is known: each stored entry holds the
+        discounted sum of the next `n_step` rewards and the state `n_step`
+        steps ahead (or the terminal state, in which case it is done), so
+        the learner bootstraps with `gamma ** n_step`.
+        """
+
+        if self.n_step == 1:
+            self._append_step(
+                user_id,
+                items_ids,
+                group_counts,
+                action,
+                reward,
+                next_items_ids,
+                next_group_counts,
+                done,
+            )
+            return
+
+        self.window.append((user_id, items_ids, group_counts, action, reward))
+        if not done and len(self.window) < self.n_step:
+            return
+
+        returns = n_step_returns(
+            np.array([w[4] for w in self.window], dtype=np.float64),
+            self.gamma,
+            self.n_step,
+        )
+        # without the end of the episode only the oldest return is complete
+        n_ready = len(self.window) if done else 1
+        for w, R in zip(self.window[:n_ready], returns[:n_ready]):
+            self._append_step(*w[:4], R, next_items_ids, next_group_counts, done)
+        del self.window[:n_ready]
+
+    def _append_step(
+        self,
+        user_id,
+        items_ids,
+        group_counts,
+        action,
+        reward,
+        next_items_ids,
+        next_group_counts,
+        done,
+    ):
+        row = self.n_staged
+        if row == 0 and self.flush_event is not None:
+            # the previous chunk may still be copying from the staging rows
+            self.flush_event.synchronize()
+            self.flush_event = None
+
+        n_items = len(items_ids)
+        states = self.staging_np["states"][row]
+        states[0] = user_id
+        states[1 : n_items + 1] = items_ids
+        states[n_items + 1 :] = group_counts
+
+        next_states = self.staging_np["next_states"][row]
+        next_states[0] = user_id
+        next_states[1 : n_items + 1] = next_items_ids
+        next_states[n_items + 1 :] = next_group_counts
+
+        self.staging_np["actions"][row] = action
+        self.staging_np["rewards"][row] = reward
+        self.staging_np["dones"][row] = done
+
+        self._link(self.crt_idx, states, next_states, done)
+        self.staged_index[row] = self.crt_idx
+        self._advance(done)
+
+        self.n_staged += 1
+        if self.n_staged == self.staging_size:
+            self.flush()
+
+    def flush(self):
+        """Copy the staged rows into the buffer storage and make them
+        available for sampling."""
+
+        if self.n_staged == 0:
+            return
+
+        n = self.n_staged
+        self._store_batch(
+            torch.from_numpy(self.staged_index[:n]).to(self.storage_device),
+            *(
+                self.staging[k][:n].to(self.storage_device, non_blocking=True)
+                for k in ("states", "actions", "rewards", "next_states", "dones")
+            ),
+        )
+        if torch.device(self.storage_device).type == "cuda":
+            self.flush_event = torch.cuda.Event()
+            self.flush_event.record()
+        self.tree.update_priorities(
+            np.full(n, self.max_priority**self.alpha), self.staged_index[:n]
+        )
+        self.n_staged = 0
+
+    def __len__(self):
+        return self.buffer_size if self.is_full else self.crt_idx
+
     def sample(self, batch_size):
-        rd_idx = []
-        weight_batch = []
-        index_batch = []
-        sum_priority = self.sum_tree.sum_all_priority()
+        self.flush()
+        sum_priority = self.tree.sum_all_priority()
 
-        N = self.buffer_size if self.is_full else self.crt_idx
-        min_priority = self.min_tree.min_priority() / sum_priority
+        N = len(self)
+        min_priority = self.tree.min_priority() / sum_priority
         max_weight = (N * min_priority) ** (-self.beta)
 
+        # stratified sampling: one uniform draw in each of the batch_size segments
         segment_size = sum_priority / batch_size
-        for j in range(batch_size):
-            min_seg = segment_size * j
-            max_seg = segment_size * (j + 1)
-
-            random_num = random.uniform(min_seg, max_seg)
-            priority, tree_index, buffer_index = self.sum_tree.search(random_num)
-            rd_idx.append(buffer_index)
-
-            p_j = priority / sum_priority
-            w_j = (p_j * N) ** (-self.beta) / max_weight
-            weight_batch.append(w_j)
-            index_batch.append(tree_index)
-        self.beta = min(1.0, self.beta + self.beta_constant)
+        random_nums = (
+            np.arange(batch_size) + np.random.uniform(size=batch_size)
+        ) * segment_size
+        priorities, index_batch = self.tree.batch_search(random_nums)
 
-        batch_states = self.states[rd_idx]
-        batch_actions = self.actions[rd_idx]
-        batch_rewards = self.rewards[rd_idx]
-        batch_next_states = self.next_states[rd_idx]
-        batch_dones = self.dones[rd_idx]
+        p_j = priorities.astype(np.float64) / sum_priority
+        weight_batch = (p_j * N) ** (-self.beta) / max_weight
+        self.beta = min(1.0, self.beta + self.beta_constant)
 
         return (
-            batch_states,
-            batch_actions,
-            batch_rewards,
-            batch_next_states,
-            batch_dones,
+            *self._gather(index_batch),
             torch.FloatTensor(weight_batch).to(self.device),
             index_batch,
         )
 
+    def sample_sequences(self, batch_size, sequence_length, max_tries=100):
+        """Sample contiguous sequences of entries within episode boundaries.
+
+        Start slots are drawn uniformly and redrawn, all at once, until
+        every sequence lies in a single episode and does not run past the
+        newest entry.
+
+        Returns
+        -------
+        The same tuple as `sample`, with a `(batch_size, sequence_length)`
+        leading shape and uniform weights.
+        """
+
+        self.flush()
+        N = self.buffer_size if self.is_full else self.crt_idx
+        offsets = np.arange(sequence_length)
+
+        starts = np.random.randint(0, N, size=batch_size)
+        for _ in range(max_tries):
+            # age of each slot with respect to the oldest entry
+            ages = (starts - self.crt_idx) % N if self.is_full else starts
+            slots = (starts[:, None] + offsets) % self.buffer_size
+            valid = (ages + sequence_length <= N) & (
+                self.episodes[slots] == self.episodes[starts][:, None]
+            ).all(axis=1)
+            if valid.all():
+                break
+            starts[~valid] = np.random.randint(0, N, size=int((~valid).sum()))
+        else:
+            raise ValueError(
+                "Could not sample {} sequences of length {}.".format(
+                    batch_size, sequence_length
+                )
+            )
+
+        index_batch = slots.reshape(-1)
+        return (
+            *(
+                t.reshape(batch_size, sequence_length, *t.shape[1:])
+                for t in self._gather(index_batch)
+            ),
+            torch.ones((batch_size, sequence_length), device=self.device),
+            slots,
+        )
+
+    def _link(self, index, state, next_state, done):
+        pass
+
+    def _store(self, index, state, action, reward, next_state, done):
+        self.states[index] = state
+        self.actions[index] = action
+        self.rewards[index] = reward
+        self.next_states[index] = next_state
+        self.dones[index] = done
+
+    def _store_batch(self, indices, states, actions, rewards, next_states, dones):
+        self.states.index_copy_(0, indices, states)
+        self.actions.index_copy_(0, indices, actions)
+        self.rewards.index_copy_(0, indices, rewards)
+        self.next_states.index_copy_(0, indices, next_states)
+        self.dones.index_copy_(0, indices, dones)
+
+    def _gather(self, indices):
+        rd_idx = torch.from_numpy(indices).to(self.storage_device)
+        return (
+            self.states[rd_idx].to(self.device),
+            self.actions[rd_idx].to(self.device),
+            self.rewards[rd_idx].to(self.device),
+            self.next_states[rd_idx].to(self.device),
+            self.dones[rd_idx].to(self.device),
+        )
+
     def update_priority(self, priority, index):
-        self.sum_tree.update_priority(priority**self.alpha, index)
-        self.min_tree.update_priority(priority**self.alpha, index)
+        self.tree.update_priority(priority**self.alpha, index)
         self.update_max_priority(priority**self.alpha)
 
+    def update_priorities(self, priorities, indices):
+        priorities = np.asarray(priorities, dtype=np.float64) ** self.alpha
+        self.tree.update_priorities(priorities, indices)
+        self.update_max_priority(float(priorities.max()))
+
     def update_max_priority(self, priority):
         self.max_priority = max(self.max_priority, priority)
+
+
+class CompactPriorityExperienceReplay(PriorityExperienceReplay):
+    """Priority replay buffer with integer observation storage.
+
+    Observations are `[user_id, items_ids..., group_counts...]` rows. They
+    are stored as int32 user and item ids and int16 group counts instead
+    of float32, and the next state is not stored at all: within an
+    episode the next state of step t is the state of step t + n_step, so
+    each entry only keeps a pointer to the slot that holds it. The next
+    states of the newest entries, whose target slot is not written yet, are
+    kept aside until it is. Terminal entries point to themselves since their
+    next state is masked out of the TD target by `dones`.
+
+    `sample` rebuilds the same float32 tensors as PriorityExperienceReplay.
+    """
+
+    def __init__(
+        self,
+        buffer_size,
+        embedding_dim,
+        state_size,
+        n_groups,
+        device,
+        tree_dtype=np.float64,
+        staging_size=256,
+        n_step=1,
+        gamma=0.9,
+    ):
+        self.device = device
+        self.storage_device = device
+
+        self.buffer_size = buffer_size
+        self.state_size = state_size
+        self.n_groups = n_groups
+        self.crt_idx = 0
+        self.is_full = False
+
+        self.users = torch.zeros(buffer_size, dtype=torch.int32).to(device)
+        self.items = torch.zeros((buffer_size, state_size), dtype=torch.int32).to(
+            device
+        )
+        self.group_counts = torch.zeros((buffer_size, n_groups), dtype=torch.int16).to(
+            device
+        )
+        self.next_index = np.zeros(buffer_size, dtype=np.int32)
+
+        self.actions = torch.zeros(
+            (buffer_size, embedding_dim), dtype=torch.float32
+        ).to(device)
+        self.rewards = torch.zeros((buffer_size), dtype=torch.float32).to(device)
+        self.dones = torch.zeros(buffer_size, dtype=torch.bool).to(device)
+
+        # {target slot: (slot, next state)} of the entries whose target slot
+        # is not written yet, and {slot: next state} of the entries whose
+        # target slot got a different state (e.g. the caller switched
+        # episodes without marking the transition as done)
+        self.pending_next_states = {}
+        self.detached_next_states = {}
+
+        self.tree = SegmentTree(buffer_size, dtype=tree_dtype)
+
+        self.max_priority = 1.0
+        self.alpha = 0.6
+        self.beta = 0.4
+        self.beta_constant = 0.00001
+
+        self._init_staging(staging_size, embedding_dim, 1 + state_size + n_groups)
+        self._init_n_step(n_step, gamma)
+
+    def _link(self, index, state, next_state, done):
+        pending = self.pending_next_states.pop(index, None)
+        if pending is not None and not np.array_equal(pending[1], state):
+            self.detached_next_states[pending[0]] = pending[1]
+        self.detached_next_states.pop(index, None)
+
+        if bool(done):
+            self.next_index[index] = index
+        else:
+            target = (index + self.n_step) % self.buffer_size
+            self.next_index[index] = target
+            self.pending_next_states[target] = (
+                index,
+                np.array(next_state, dtype=np.float32),
+            )
+
+    def _store(self, index, state, action, reward, next_state, done):
+        state = torch.as_tensor(state, device=self.device).reshape(-1)
+        self._link(
+            index,
+            state.cpu().numpy(),
+            torch.as_tensor(next_state).reshape(-1).cpu().numpy(),
+            done,
+        )
+
+        self.users[index] = state[0]
+        self.items[index] = state[1 : self.state_size + 1]
+        self.group_counts[index] = state[self.state_size + 1 :]
+        self.actions[index] = action
+        self.rewards[index] = reward
+        self.dones[index] = done
+
+    def _store_batch(self, indices, states, actions, rewards, next_states, dones):
+        self.users.index_copy_(0, indices, states[:, 0].int())
+        self.items.index_copy_(0, indices, states[:, 1 : self.state_size + 1].int())
+        self.group_counts.index_copy_(
+            0, indices, states[:, self.state_size + 1 :].short()
+        )
+        self.actions.index_copy_(0, indices, actions)
+        self.rewards.index_copy_(0, indices, rewards)
+        self.dones.index_copy_(0, indices, dones)
+
+    def _observations(self, rd_idx):
+        return torch.cat(
+            (
+                self.users[rd_idx].unsqueeze(1),
+                self.items[rd_idx],
+                self.group_counts[rd_idx],
+            ),
+            1,
+        ).float()
+
+    def _gather(self, indices):
+        rd_idx = torch.from_numpy(indices).to(self.device)
+        next_rd_idx = torch.from_numpy(self.next_index[indices]).long().to(self.device)
+
+        batch_next_states = self._observations(next_rd_idx)
+        if self.pending_next_states:
+            targets = self.next_index[indices]
+            for j in np.flatnonzero(np.isin(targets, list(self.pending_next_states))):
+                index, next_state = self.pending_next_states[int(targets[j])]
+                if index == indices[j]:
+                    batch_next_states[j] = torch.from_numpy(next_state).to(self.device)
+        if self.detached_next_states:
+            for j in np.flatnonzero(np.isin(indices, list(self.detached_next_states))):
+                batch_next_states[j] = torch.from_numpy(
+                    self.detached_next_states[int(indices[j])]
+                ).to(self.device)
+
+        return (
+            self._observations(rd_idx),
+            self.actions[rd_idx],
+            self.rewards[rd_idx],
+            batch_next_states,
+            self.dones[rd_idx],
+        )
+
+
+class DiskPriorityExperienceReplay(PriorityExperienceReplay):
+    """Priority replay buffer backed by memory-mapped files.
+
+    The storage arrays and the priority tree are `.npy` memmaps under
+    `path`, and the cursor, priority and annealing state are kept in
+    `meta.json`. `checkpoint` flushes the dirty pages, saves a copy of the
+    tree and rewrites the metadata, so an existing buffer is reopened
+    without unpickling and can be larger than the available RAM. Sampled
+    batches are moved to `device`.
+
+    Resuming restores the tree saved by the last checkpoint, so the rows
+    appended after it (whose pages may not have been written back) are
+    never sampled and are overwritten from the saved cursor. Once the
+    buffer has wrapped, the slots rewritten after the checkpoint keep
+    their saved priorities but may hold the newer transitions.
+
+    Parameters
+    ----------
+    path: string
+        Directory holding the buffer files.
+
+    resume: boolean
+        If set and `path` holds a buffer, reopen it with its saved state.
+        Otherwise a new empty buffer is created.
+    """
+
+    def __init__(
+        self,
+        path,
+        buffer_size,
+        embedding_dim,
+        obs_size,
+        device,
+        tree_dtype=np.float64,
+        staging_size=256,
+        n_step=1,
+        gamma=0.9,
+        resume=True,
+    ):
+        self.path = path
+        self.device = device
+        self.storage_device = "cpu"
+
+        self.buffer_size = buffer_size
+        self.crt_idx = 0
+        self.is_full = False
+
+        self.max_priority = 1.0
+        self.alpha = 0.6
+        self.beta = 0.4
+        self.beta_constant = 0.00001
+
+        tree_capacity = 1 << max(0, int(buffer_size - 1).bit_length())
+        layout = {
+            "states": ((buffer_size, obs_size), np.float32),
+            "actions": ((buffer_size, embedding_dim), np.float32),
+            "rewards": ((buffer_size,), np.float32),
+            "next_states": ((buffer_size, obs_size), np.float32),
+            "dones": ((buffer_size,), np.bool_),
+            "episodes": ((buffer_size,), np.int64),
+            "tree": ((2 * tree_capacity, 2), np.dtype(tree_dtype)),
+        }
+
+        resume = resume and os.path.isfile(self._meta_path())
+        os.makedirs(path, exist_ok=True)
+        self.arrays = {}
+        for field, (shape, dtype) in layout.items():
+            self.arrays[field] = np.lib.format.open_memmap(
+                os.path.join(path, "{}.npy".format(field)),
+                mode="r+" if resume else "w+",
+                dtype=dtype,
+                shape=shape,
+            )
+            if self.arrays[field].shape != shape or self.arrays[field].dtype != dtype:
+                raise ValueError(
+                    "Buffer file {}.npy does not match the buffer configuration.".format(
+                        field
+                    )
+                )
+
+        self.states = torch.from_numpy(self.arrays["states"])
+        self.actions = torch.from_numpy(self.arrays["actions"])
+        self.rewards = torch.from_numpy(self.arrays["rewards"])
+        self.next_states = torch.from_numpy(self.arrays["next_states"])
+        self.dones = torch.from_numpy(self.arrays["dones"])
+
+        if resume:
+            with open(self._meta_path()) as f:
+                meta = json.load(f)
+            self.crt_idx = meta["crt_idx"]
+            self.is_full = meta["is_full"]
+            self.max_priority = meta["max_priority"]
+            self.beta = meta["beta"]
+            self._restore_tree(meta.get("tree"))
+        else:
+            SegmentTree.clear(self.arrays["tree"])
+        self.tree = SegmentTree(buffer_size, dtype=tree_dtype, tree=self.arrays["tree"])
+        self.tree_file = meta.get("tree") if resume else None
+
+        self._init_staging(staging_size, embedding_dim, obs_size)
+        self._init_n_step(n_step, gamma)
+        self.episodes = self.arrays["episodes"]
+        if resume:
+            self.episode = meta["episode"]
+
+    def _meta_path(self):
+        return os.path.join(self.path, "meta.json")
+
+    def _restore_tree(self, tree_file):
+        tree = self.arrays["tree"]
+        if tree_file is not None:
+            saved = np.load(os.path.join(self.path, tree_file))
+            if saved.shape != tree.shape or saved.dtype != tree.dtype:
+                raise ValueError("Saved tree does not match the buffer configuration.")
+            tree[:] = saved
+        elif not self.is_full:
+            # buffer checkpointed without a tree copy: drop the leaves past
+            # the saved cursor, the rows appended after the checkpoint
+            capacity = tree.shape[0] // 2
+            leaves = tree[capacity : capacity + self.crt_idx, SUM].copy()
+            SegmentTree.clear(tree)
+            if self.crt_idx > 0:
+                SegmentTree(
+                    self.buffer_size, dtype=tree.dtype, tree=tree
+                ).update_priorities(leaves, np.arange(self.crt_idx))
+
+    def _store(self, index, state, action, reward, next_state, done):
+        super()._store(
+            index,
+            torch.as_tensor(state).cpu(),
+            torch.as_tensor(action).cpu(),
+            torch.as_tensor(reward).cpu(),
+            torch.as_tensor(next_state).cpu(),
+            torch.as_tensor(done).cpu(),
+        )
+
+    def clear(self):
+        """Empty the buffer. The files are kept and overwritten in place."""
+
+        self.n_staged = 0
+        self.crt_idx = 0
+        self.is_full = False
+        self.max_priority = 1.0
+        self.beta = 0.4
+        self.window = []
+        self.episode = 0
+        SegmentTree.clear(self.arrays["tree"])
+
+    def checkpoint(self):
+        """Flush the staged rows and the dirty pages of every memmap, save a
+        copy of the tree, then atomically rewrite the metadata.
+
+        The tree copy is a new file per checkpoint, named in the metadata,
+        so the metadata and the tree it points to always match.
+        """
+
+        self.flush()
+        for array in self.arrays.values():
+            array.flush()
+
+        previous = self.tree_file
+        self.tree_file = "tree.{}.npy".format(
+            int(previous.split(".")[1]) + 1 if previous else 1
+        )
+        tree_path = os.path.join(self.path, self.tree_file)
+        with open(tree_path + ".tmp", "wb") as f:
+            np.save(f, self.arrays["tree"])
+        os.replace(tree_path + ".tmp", tree_path)
+
+        meta_path = self._meta_path()
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "crt_idx": self.crt_idx,
+                    "is_full": self.is_full,
+                    "max_priority": self.max_priority,
+                    "beta": self.beta,
+                    "episode": self.episode,
+                    "tree": self.tree_file,
+                },
+                f,
+            )
+        os.replace(meta_path + ".tmp", meta_path)
+
+        if previous and previous != self.tree_file:
+            os.remove(os.path.join(self.path, previous))
+
+
+class ShardedPriorityExperienceReplay(PriorityExperienceReplay):
+    """Priority replay buffer shared by several processes.
+
+    The storage, the priority tree and the cursor of each shard live in
+    shared memory, so after a fork every actor process appends to its own
+    shard (`set_shard`) while the learner samples from all of them. Each
+    writer owns a contiguous range of `buffer_size / n_shards` slots, so no
+    slot is written concurrently; staged rows are published to the tree in
+    chunks, and only the tree updates, the chunk copies and the sampling
+    take the shared lock. The max priority used for new entries and the
+    episode of each slot are shared as well.
+
+    Parameters
+    ----------
+    n_shards: int
+        Number of writer processes (shard 0 is the learner's).
+    """
+
+    def __init__(
+        self,
+        buffer_size,
+        embedding_dim,
+        obs_size,
+        device,
+        n_shards=2,
+        tree_dtype=np.float64,
+        staging_size=256,
+        n_step=1,
+        gamma=0.9,
+    ):
+        self.device = device
+        self.storage_device = "cpu"
+
+        self.n_shards = n_shards
+        self.shard_size = -(-buffer_size // n_shards)
+        self.buffer_size = self.shard_size * n_shards
+
+        self.alpha = 0.6
+        self.beta = 0.4
+        self.beta_constant = 0.00001
+
+        self.states = torch.zeros((self.buffer_size, obs_size)).share_memory_()
+        self.actions = torch.zeros((self.buffer_size, embedding_dim)).share_memory_()
+        self.rewards = torch.zeros(self.buffer_size).share_memory_()
+        self.next_states = torch.zeros((self.buffer_size, obs_size)).share_memory_()
+        self.dones = torch.zeros(self.buffer_size, dtype=torch.bool).share_memory_()
+
+        # cursor and is_full flag of each shard, and the max priority
+        self.shard_state = torch.zeros((n_shards, 2), dtype=torch.int64).share_memory_()
+        self.shared_max_priority = torch.ones(1, dtype=torch.float64).share_memory_()
+
+        tree_capacity = 1 << max(0, int(self.buffer_size - 1).bit_length())
+        self.tree_array = torch.from_numpy(
+            np.empty((2 * tree_capacity, 2), dtype=tree_dtype)
+        ).share_memory_()
+        SegmentTree.clear(self.tree_array.numpy())
+        self.tree = SegmentTree(
+            self.buffer_size, dtype=tree_dtype, tree=self.tree_array.numpy()
+        )
+        self.lock = multiprocessing.get_context("fork").RLock()
+
+        self._init_staging(staging_size, embedding_dim, obs_size)
+        self._init_n_step(n_step, gamma)
+        self.episodes_array = torch.zeros(
+            self.buffer_size, dtype=torch.int64
+        ).share_memory_()
+        self.episodes = self.episodes_array.numpy()
+        self.set_shard(0)
+
+    @property
+    def max_priority(self):
+        return float(self.shared_max_priority[0])
+
+    @max_priority.setter
+    def max_priority(self, priority):
+        self.shared_max_priority[0] = priority
+
+    def set_shard(self, shard_id):
+        """Write the next transitions of this process to shard `shard_id`,
+        from its last published position."""
+
+        self.flush()
+        self.shard_id = shard_id
+        self.offset = shard_id * self.shard_size
+        cursor, is_full = self.shard_state[shard_id].tolist()
+        self.crt_idx = self.offset + cursor
+        self.is_full = bool(is_full)
+        self.window = []
+
+    def _advance(self, done):
+        self.episodes[self.crt_idx] = self.episode
+        if done:
+            self.episode += 1
+
+        cursor = (self.crt_idx - self.offset + 1) % self.shard_size
+        self.crt_idx = self.offset + cursor
+        if cursor == 0:
+            self.is_full = True
+
+    def _publish(self):
+        self.shard_state[self.shard_id, 0] = self.crt_idx - self.offset
+        self.shard_state[self.shard_id, 1] = self.is_full
+
+    def append(self, state, action, reward, next_state, done):
+        with self.lock:
+            super().append(state, action, reward, next_state, done)
+            self._publish()
+
+    def flush(self):
+        if self.n_staged == 0:
+            return
+
+        with self.lock:
+            super().flush()
+            self._publish()
+
+    def __len__(self):
+        cursors, full = self.shard_state.numpy().T
+        return int(np.where(full, self.shard_size, cursors).sum())
+
+    def sample(self, batch_size):
+        with self.lock:
+            return super().sample(batch_size)
+
+    def sample_sequences(self, batch_size, sequence_length, max_tries=100):
+        """Sample contiguous sequences of entries within one shard and one
+        episode, as in PriorityExperienceReplay.sample_sequences.
+
+        Start slots are drawn uniformly over the published entries of every
+        shard, and a sequence never runs past the published cursor of its
+        shard.
+        """
+
+        self.flush()
+        offsets = np.arange(sequence_length)
+        with self.lock:
+            cursors, full = self.shard_state.numpy().T.copy()
+            sizes = np.where(full, self.shard_size, cursors)
+            ends = np.cumsum(sizes)
+
+            def draw(n):
+                # shard and position of n entries drawn over all the shards
+                ranks = np.random.randint(0, ends[-1], size=n)
+                shards = np.searchsorted(ends, ranks, side="right")
+                return shards, ranks - ends[shards] + sizes[shards]
+
+            shards, positions = draw(batch_size)
+            for _ in range(max_tries):
+                # age of each start with respect to the oldest entry of its shard
+                ages = np.where(
+                    full[shards],
+                    (positions - cursors[shards]) % self.shard_size,
+                    positions,
+                )
+                slots = shards[:, None] * self.shard_size + (
+                    (positions[:, None] + offsets) % self.shard_size
+                )
+                valid = (ages + sequence_length <= sizes[shards]) & (
+                    self.episodes[slots] == self.episodes[slots[:, :1]]
+                ).all(axis=1)
+                if valid.all():
+                    break
+                shards[~valid], positions[~valid] = draw(int((~valid).sum()))
+            else:
+                raise ValueError(
+                    "Could not sample {} sequences of length {}.".format(
+                        batch_size, sequence_length
+                    )
+                )
+
+            batch = self._gather(slots.reshape(-1))
+
+        return (
+            *(t.reshape(batch_size, sequence_length, *t.shape[1:]) for t in batch),
+            torch.ones((batch_size, sequence_length), device=self.device),
+            slots,
+        )
+
+    def update_priority(self, priority, index):
+        with self.lock:
+            super().update_priority(priority, index)
+
+    def update_priorities(self, priorities, indices):
+        with self.lock:
+            super().update_priorities(priorities, indices)
+
+    def __getstate__(self):
+        # the lock and the tree and episodes views are rebuilt when unpickling
+        state = self.__dict__.copy()
+        del state["lock"], state["tree"], state["episodes"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tree = SegmentTree(
+            self.buffer_size,
+            dtype=self.tree_array.numpy().dtype,
+            tree=self.tree_array.numpy(),
+        )
+        self.episodes = self.episodes_array.numpy()
+        self.lock = multiprocessing.get_context("fork").RLock()
+
+
+def n_step_returns(rewards, gamma, n_step):
+    """Discounted sum of the next `n_step` rewards at every position, as a
+    rolling window over the zero-padded rewards."""
+
+    padded = np.concatenate((rewards, np.zeros(n_step - 1)))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, n_step)
+    return windows @ (gamma ** np.arange(n_step))
@@ -1,83 +1,176 @@
 import numpy as np
 
-
-class SumTree:
-    def __init__(self, buffer_size):
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# columns of the interleaved tree array
+SUM = 0
+MIN = 1
+
+
+def _update_numpy(tree, leaves, priorities):
+    tree[leaves, SUM] = priorities
+    tree[leaves, MIN] = priorities
+
+    parents = np.unique(leaves // 2)
+    while parents[0] > 0:
+        left = tree[parents * 2]
+        right = tree[(parents * 2) + 1]
+        tree[parents, SUM] = left[:, SUM] + right[:, SUM]
+        tree[parents, MIN] = np.minimum(left[:, MIN], right[:, MIN])
+        parents = np.unique(parents // 2)
+
+
+def _search_numpy(tree, nums, depth):
+    # a child with a zero sum only holds empty or padding leaves, so the
+    # search never enters it: values past the last filled leaf (rounding
+    # of the sums) end on that leaf
+    current = np.ones(nums.shape[0], dtype=np.int64)
+    for _ in range(depth):
+        left = current * 2
+        left_priority = tree[left, SUM]
+        right_priority = tree[left + 1, SUM]
+
+        go_right = ((nums > left_priority) & (right_priority > 0)) | (
+            left_priority <= 0
+        )
+        nums = np.where(go_right, nums - left_priority, nums)
+        current = left + go_right
+
+    return current
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _update_numba(tree, leaves, priorities):
+        for j in range(leaves.shape[0]):
+            index = leaves[j]
+            tree[index, SUM] = priorities[j]
+            tree[index, MIN] = priorities[j]
+            index //= 2
+            while index > 0:
+                left = index * 2
+                tree[index, SUM] = tree[left, SUM] + tree[left + 1, SUM]
+                tree[index, MIN] = min(tree[left, MIN], tree[left + 1, MIN])
+                index //= 2
+
+    @numba.njit(cache=True)
+    def _search_numba(tree, nums, depth):
+        current = np.ones(nums.shape[0], dtype=np.int64)
+        for j in range(nums.shape[0]):
+            num = nums[j]
+            index = 1
+            for _ in range(depth):
+                left = index * 2
+                left_priority = tree[left, SUM]
+                right_priority = tree[left + 1, SUM]
+                # never enter a child holding only empty or padding leaves
+                if (num > left_priority and right_priority > 0) or left_priority <= 0:
+                    num -= left_priority
+                    index = left + 1
+                else:
+                    index = left
+            current[j] = index
+
+        return current
+
+
+class SegmentTree:
+    """Sum/min segment tree over the priorities of a replay buffer.
+
+    Leaves are padded to a power of two and stored after the internal
+    nodes (root at index 1). The sum and the min of each node are
+    interleaved in one `(2 * capacity, 2)` array, so a single ancestor walk
+    keeps both up to date and root reads are O(1). Padding and empty leaves
+    hold a zero sum and an infinite min, so they are never sampled and
+    never lower the min.
+
+    When numba is installed the update and search loops are compiled,
+    otherwise they run as level-by-level NumPy operations.
+
+    Parameters
+    ----------
+    buffer_size: int
+        Number of leaves (replay buffer capacity).
+
+    dtype: numpy dtype
+        Dtype of the tree. float32 halves the memory of large buffers.
+
+    use_numba: bool
+        Use the compiled kernels. Defaults to True when numba is available.
+
+    tree: array
+        Existing `(2 * capacity, 2)` array (e.g. a np.memmap) holding the
+        tree. If not provided a new empty tree is allocated.
+    """
+
+    def __init__(self, buffer_size, dtype=np.float64, use_numba=None, tree=None):
         self.buffer_size = buffer_size
-        self.tree = np.zeros((buffer_size * 2 - 1))
-        self.index = buffer_size - 1
-
-    def update_tree(self, index):
-        while True:
-            index = (index - 1) // 2
-            left = (index * 2) + 1
-            right = (index * 2) + 2
-            self.tree[index] = self.tree[left] + self.tree[right]
-            if index == 0:
-                break
-
-    def add_data(self, priority):
-        if self.index == self.buffer_size * 2 - 1:
-            self.index = self.buffer_size - 1
-
-        self.tree[self.index] = priority
-        self.update_tree(self.index)
-        self.index += 1
+        self.dtype = np.dtype(dtype)
 
-    def search(self, num):
-        current = 0
-        while True:
-            left = (current * 2) + 1
-            right = (current * 2) + 2
+        self.depth = max(0, int(buffer_size - 1).bit_length())
+        self.capacity = 1 << self.depth
 
-            if num <= self.tree[left]:
-                current = left
-            else:
-                num -= self.tree[left]
-                current = right
+        if tree is None:
+            tree = np.empty((2 * self.capacity, 2), dtype=self.dtype)
+            self.clear(tree)
+        elif tree.shape != (2 * self.capacity, 2) or tree.dtype != self.dtype:
+            raise ValueError("Tree array does not match the buffer size and dtype.")
+        self.tree = tree
 
-            if current >= self.buffer_size - 1:
-                break
+        use_numba = numba is not None if use_numba is None else use_numba
+        if use_numba and numba is None:
+            raise ImportError("numba is required for the compiled tree kernels.")
+        self._update = _update_numba if use_numba else _update_numpy
+        self._search = _search_numba if use_numba else _search_numpy
 
-        return self.tree[current], current, current - self.buffer_size + 1
+    @staticmethod
+    def clear(tree):
+        tree[:, SUM] = 0
+        tree[:, MIN] = np.inf
 
     def update_priority(self, priority, index):
-        self.tree[index] = priority
-        self.update_tree(index)
-
-    def sum_all_priority(self):
-        return float(self.tree[0])
+        self.update_priorities(np.array([priority]), np.array([index]))
 
+    def update_priorities(self, priorities, indices):
+        leaves = np.asarray(indices, dtype=np.int64) + self.capacity
+        if leaves.shape[0] == 0:
+            # e.g. a batch whose indices were all filtered out
+            return
+        priorities = np.asarray(priorities, dtype=self.dtype)
+        self._update(self.tree, leaves, priorities)
 
-class MinTree:
-    def __init__(self, buffer_size):
-        self.buffer_size = buffer_size
-        self.tree = np.ones((buffer_size * 2 - 1))
-        self.index = buffer_size - 1
-
-    def update_tree(self, index):
-        while True:
-            index = (index - 1) // 2
-            left = (index * 2) + 1
-            right = (index * 2) + 2
-            if self.tree[left] > self.tree[right]:
-                self.tree[index] = self.tree[right]
-            else:
-                self.tree[index] = self.tree[left]
-            if index == 0:
-                break
-
-    def add_data(self, priority):
-        if self.index == self.buffer_size * 2 - 1:
-            self.index = self.buffer_size - 1
-
-        self.tree[self.index] = priority
-        self.update_tree(self.index)
-        self.index += 1
+    def search(self, num):
+        priorities, indices = self.batch_search(np.array([num]))
+        return priorities[0], indices[0]
+
+    def batch_search(self, nums):
+        """Find the leaves holding each prefix sum in `nums`.
+
+        `nums` are clamped below the total priority, and a search always
+        ends on a leaf with a positive priority (if there is one), so
+        values rounded up to the total select the last filled leaf.
+
+        Returns
+        -------
+        priorities: array
+            Priority stored in each selected leaf.
+        indices: array
+            Buffer index of each selected leaf.
+        """
+
+        nums = np.asarray(nums, dtype=self.dtype)
+        total = self.tree[1, SUM]
+        nums = np.clip(nums, 0, np.nextafter(total, self.dtype.type(0)))
+        leaves = self._search(self.tree, nums, self.depth)
+        return self.tree[leaves, SUM], leaves - self.capacity
 
-    def update_priority(self, priority, index):
-        self.tree[index] = priority
-        self.update_tree(index)
+    def sum_all_priority(self):
+        return float(self.tree[1, SUM])
 
     def min_priority(self):
-        return float(self.tree[0])
+        return float(self.tree[1, MIN])
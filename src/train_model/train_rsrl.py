@@ -10,7 +10,6 @@ import torch
 import numpy as np
 import random
 import pandas as pd
-from tqdm import tqdm
 import recmetrics as rm
 from random import sample
 
@@ -18,6 +17,9 @@ import plotly.graph_objects as go
 import plotly_express as px
 
 from src.environment import OfflineEnv, OfflineFairEnv
+from src.environment.drr_env import build_group_index
+from src.data.histories import load_user_histories
+from src.data.item_features import ItemFeatureStore
 from src.model.recommender import DRRAgent, FairRecAgent
 from src.recsys_fair_metrics.recsys_fair import RecsysFair
 
@@ -60,6 +62,15 @@ class RSRL(luigi.Task):
     reward_model: str = luigi.Parameter(default="")
     embedding_network_weights: str = luigi.Parameter(default="")
     use_reward_model: bool = luigi.BoolParameter(default=True)
+    compact_buffer: bool = luigi.BoolParameter(default=False)
+    disk_buffer: bool = luigi.BoolParameter(default=False)
+    n_step: int = luigi.IntParameter(default=1)
+    sequence_length: int = luigi.IntParameter(default=1)
+    n_actors: int = luigi.IntParameter(default=1)
+    n_envs: int = luigi.IntParameter(default=1)
+    reward_cache_mb: int = luigi.IntParameter(default=0)
+    eval_workers: int = luigi.IntParameter(default=1)
+    eval_batch_size: int = luigi.IntParameter(default=1)
 
     train_version: str = luigi.Parameter()
     use_wandb: bool = luigi.BoolParameter()
@@ -122,11 +133,45 @@ class RSRL(luigi.Task):
 
         with open(_dataset_path["item_groups"], "rb") as pkl_file:
             dataset["item_groups"] = pickle.load(pkl_file)
+        dataset["group_index"] = build_group_index(
+            dataset["item_groups"], self.n_groups
+        )
+
+        # histories precomputed by the dataset stage, if it compiled them for
+        # this state size and reward threshold
+        for split in ("train_histories", "eval_histories"):
+            dataset[split] = (
+                load_user_histories(
+                    _dataset_path[split], self.state_size, self.reward_threshold
+                )
+                if split in _dataset_path
+                else None
+            )
 
         dataset["items_df"] = pd.read_csv(_dataset_path["items_df"])
         dataset["items_metadata"] = pd.read_csv(_dataset_path["items_metadata"])
         dataset["title_emb"] = _dataset_path["title_emb"]
 
+        # item features shared by the fair environments, memory mapped when
+        # the dataset stage saved them
+        if "title_features" in _dataset_path:
+            dataset["item_features"] = ItemFeatureStore.load(
+                {
+                    name: _dataset_path[name + "_features"]
+                    for name in ("metadata", "title")
+                    if name + "_features" in _dataset_path
+                }
+            )
+        else:
+            dataset["item_features"] = ItemFeatureStore.from_frames(
+                dataset["items_metadata"] if "metadata" in self.user_intent else None,
+                (
+                    pd.read_csv(dataset["title_emb"])
+                    if "item_name" in self.user_intent
+                    else None
+                ),
+            )
+
         return dataset
 
     def seed_all(self):
@@ -171,6 +216,9 @@ class RSRL(luigi.Task):
             user_intent_threshold=self.user_intent_threshold,
             user_intent=self.user_intent,
             title_emb_path=dataset["title_emb"],
+            histories=dataset["train_histories"],
+            group_index=dataset["group_index"],
+            item_features=dataset["item_features"],
         )
 
         print("---------- Initialize Agent")
@@ -199,6 +247,15 @@ class RSRL(luigi.Task):
             n_groups=self.n_groups,
             fairness_constraints=self.fairness_constraints,
             use_reward_model=self.use_reward_model,
+            compact_buffer=self.compact_buffer,
+            buffer_path=(
+                os.path.join(self.output_path, "buffer") if self.disk_buffer else None
+            ),
+            n_step=self.n_step,
+            sequence_length=self.sequence_length,
+            n_actors=self.n_actors,
+            n_envs=self.n_envs,
+            reward_cache_mb=self.reward_cache_mb,
             no_cuda=self.no_cuda,
         )
 
@@ -262,6 +319,9 @@ class RSRL(luigi.Task):
                 user_intent_threshold=self.user_intent_threshold,
                 user_intent=self.user_intent,
                 title_emb_path=dataset["title_emb"],
+                histories=dataset["eval_histories"],
+                group_index=dataset["group_index"],
+                item_features=dataset["item_features"],
             )
             available_users = env.available_users
 
@@ -290,6 +350,10 @@ class RSRL(luigi.Task):
                 n_groups=self.n_groups,
                 fairness_constraints=self.fairness_constraints,
                 use_reward_model=self.use_reward_model,
+                compact_buffer=self.compact_buffer,
+                n_step=self.n_step,
+                sequence_length=self.sequence_length,
+                reward_cache_mb=self.reward_cache_mb,
                 no_cuda=self.no_cuda,
             )
 
@@ -302,8 +366,8 @@ class RSRL(luigi.Task):
             else:
                 _available_users = available_users
 
-            for user_id in tqdm(_available_users):
-                eval_env = ENV[self.algorithm](
+            def make_env(user_id):
+                return ENV[self.algorithm](
                     users_dict=dataset["eval_users_dict"],
                     n_groups=self.n_groups,
                     item_groups=dataset["item_groups"],
@@ -321,11 +385,22 @@ class RSRL(luigi.Task):
                     device=recommender.device,
                     fix_user_id=user_id,
                     title_emb_path=dataset["title_emb"],
+                    histories=env.histories,
+                    group_index=env.group_index,
+                    item_features=dataset["item_features"],
                 )
 
-                result = recommender.online_evaluate(
-                    top_k=False, load_model=True, env=eval_env
-                )
+            # load the checkpoint once, users are evaluated with these weights
+            recommender.load_last_checkpoint()
+            results = recommender.evaluate_users(
+                _available_users,
+                make_env,
+                top_k=False,
+                n_workers=self.eval_workers,
+                batch_size=self.eval_batch_size,
+            )
+
+            for user_id, result in zip(_available_users, results):
                 recommended_item.append(result["recommended_items"])
                 random_recommended_item.append({user_id: sample(catalog, k)})
                 exposure.append(result["exposure"])
@@ -364,8 +439,6 @@ class RSRL(luigi.Task):
                 user_actions[int(result["user_id"])]["relevance"] = result["relevance"]
                 user_actions[int(result["user_id"])]["fairness"] = result["fairness"]
 
-                del eval_env
-
             _precision.append(sum_precision / len(_available_users))
             _propfair.append(sum_propfair / len(_available_users))
             _ufg.append(
@@ -0,0 +1,37 @@
+import pickle
+
+import numpy as np
+
+from benchmarks.synthetic import SyntheticDataset
+
+
+def test_recommended_item_masks():
+    dataset = SyntheticDataset(20, 100, state_size=5)
+    with open(dataset.reward_model_path, "rb") as f:
+        reward_model = pickle.load(f)
+    env = dataset.make_env(done_count=6, reward_model=reward_model)
+    rng = np.random.default_rng(0)
+
+    for _ in range(5):
+        _, items, done = env.reset()
+        recommended, correct = set(items), set(items)
+        masks = env.get_recommended_items(), env.correctly_recommended
+        while not done:
+            action = int(rng.integers(100))
+            _, reward, done, info = env.step(action)
+            recommended.add(action)
+            if reward > 0:
+                correct.add(action)
+
+            assert info["recommended_items"] is env.get_recommended_items()
+            np.testing.assert_array_equal(
+                np.flatnonzero(env.get_recommended_items()), sorted(recommended)
+            )
+            np.testing.assert_array_equal(
+                np.flatnonzero(env.correctly_recommended), sorted(correct)
+            )
+
+        # every episode gets new masks
+        env.reset()
+        assert env.get_recommended_items() is not masks[0]
+        assert env.correctly_recommended is not masks[1]
@@ -0,0 +1,166 @@
+import contextlib
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from src.model.bpmf import BPMF
+from src.model.pmf import PMF
+from src.model.recommender import DRRAgent
+
+
+USERS, ITEMS, GROUPS, STATE_SIZE, EMBEDDING_DIM = 50, 200, 4, 5, 16
+
+# tensor methods that copy device data to the host (or block on it)
+HOST_METHODS = (
+    "cpu",
+    "numpy",
+    "item",
+    "tolist",
+    "__array__",
+    "__bool__",
+    "__index__",
+    "__int__",
+    "__float__",
+)
+
+
+@contextlib.contextmanager
+def count_host_syncs(counter, ignore=()):
+    """Count the device-to-host conversions of tensors in the block, except
+    for the tensors in `ignore`."""
+
+    originals = {name: getattr(torch.Tensor, name) for name in HOST_METHODS}
+    ignore = {id(tensor) for tensor in ignore}
+
+    def counting(name):
+        def method(self, *args, **kwargs):
+            if id(self) not in ignore:
+                counter.append(name)
+            return originals[name](self, *args, **kwargs)
+
+        return method
+
+    for name in HOST_METHODS:
+        setattr(torch.Tensor, name, counting(name))
+    try:
+        yield
+    finally:
+        for name, method in originals.items():
+            setattr(torch.Tensor, name, method)
+
+
+@contextlib.contextmanager
+def no_host_syncs(counter):
+    if torch.cuda.is_available():
+        # any synchronizing CUDA call raises
+        torch.cuda.set_sync_debug_mode("error")
+        try:
+            yield
+        finally:
+            torch.cuda.set_sync_debug_mode("default")
+    else:
+        with count_host_syncs(counter):
+            yield
+
+
+@pytest.fixture
+def agent(tmp_path):
+    rng = np.random.default_rng(0)
+    ratings = np.column_stack(
+        (rng.integers(0, USERS, 2000), rng.integers(0, ITEMS, 2000))
+    )
+    ratings = np.column_stack((ratings, rng.integers(1, 6, 2000))).astype(float)
+    reward_model = BPMF(USERS, ITEMS, 4, seed=0, max_rating=5, min_rating=1)
+    reward_model.fit(ratings, n_iters=2)
+    with open(tmp_path / "bpmf.pkl", "wb") as f:
+        pickle.dump(reward_model, f)
+    torch.save(PMF(USERS, ITEMS, EMBEDDING_DIM).state_dict(), str(tmp_path / "pmf.pt"))
+
+    agent = DRRAgent(
+        env=None,
+        users_num=USERS,
+        items_num=ITEMS,
+        state_size=STATE_SIZE,
+        srm_size=3,
+        srm_type="drr_paper",
+        model_path=str(tmp_path),
+        reward_model_path=str(tmp_path / "bpmf.pkl"),
+        embedding_network_weights_path=str(tmp_path / "pmf.pt"),
+        train_version="test",
+        embedding_dim=EMBEDDING_DIM,
+        n_groups=GROUPS,
+        replay_memory_size=1000,
+        batch_size=32,
+    )
+
+    # random transitions, as stored by the train loop
+    for step in range(200):
+        user = rng.integers(USERS)
+        agent.buffer.append_step(
+            user,
+            rng.integers(0, ITEMS, STATE_SIZE),
+            rng.integers(0, 3, GROUPS),
+            rng.normal(size=EMBEDDING_DIM),
+            rng.uniform(),
+            rng.integers(0, ITEMS, STATE_SIZE),
+            rng.integers(0, 3, GROUPS),
+            step % 10 == 9,
+        )
+    agent.buffer.flush()
+    return agent
+
+
+def test_learner_state_path_has_no_host_syncs(agent):
+    syncs = []
+    calls = []
+    get_state = agent.get_state
+
+    def checked_get_state(*args, **kwargs):
+        # the embedding gathers and the SRM forward of the learner step
+        calls.append(args)
+        with no_host_syncs(syncs):
+            return get_state(*args, **kwargs)
+
+    agent.get_state = checked_get_state
+    agent.update_model()
+
+    assert len(calls) == 2  # next states and states
+    assert all(torch.is_tensor(arg) for args in calls for arg in args)
+    assert syncs == []
+
+
+def test_learner_step_has_one_host_sync(agent):
+    # the first step creates the optimizer states, whose step counts are
+    # host scalars read by the optimizers
+    agent.update_model()
+    step_counts = [
+        state["step"]
+        for optimizer in (
+            agent.actor.optimizer,
+            agent.critic.optimizer,
+            agent.srm.optimizer,
+        )
+        for state in optimizer.state.values()
+    ]
+
+    syncs = []
+    with count_host_syncs(syncs, ignore=step_counts):
+        critic_loss, actor_loss = agent.update_model()
+
+    # only the TD priorities are copied to the host, for the priority tree
+    assert syncs == ["cpu", "numpy"]
+    assert torch.is_tensor(critic_loss) and torch.is_tensor(actor_loss)
+    assert critic_loss.device == actor_loss.device == torch.device(agent.device)
+
+
+def test_host_sync_counter_detects_conversions(agent):
+    batch = agent.buffer.sample(8)[0]
+    syncs = []
+    with count_host_syncs(syncs):
+        agent.get_state(
+            batch[:, 0].long().cpu().numpy(),
+            batch[:, 1 : STATE_SIZE + 1].long().tolist(),
+        )
+    assert syncs == ["cpu", "numpy", "tolist"]
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import SyntheticDataset
+
+STATE_SIZE = 5
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    return SyntheticDataset(40, 150, state_size=STATE_SIZE)
+
+
+@pytest.mark.parametrize("n_envs", [1, 3])
+def test_stored_transitions_follow_the_episodes(dataset, n_envs):
+    env = dataset.make_env(done_count=8)
+    agent = dataset.make_agent(
+        env, learning_starts=10**9, replay_memory_size=1000, n_envs=n_envs
+    )
+    agent.train(6)
+    agent.buffer.flush()
+
+    n = len(agent.buffer)
+    states = agent.buffer.states[:n].numpy()
+    next_states = agent.buffer.next_states[:n].numpy()
+    rewards = agent.buffer.rewards[:n].numpy()
+    dones = agent.buffer.dones[:n].numpy()
+    items = slice(1, STATE_SIZE + 1)
+
+    # a positive reward moves the recommended item into the next state
+    moved = (rewards > 0) & ~dones
+    assert moved.any()
+    assert (states[moved, items] != next_states[moved, items]).any(axis=1).all()
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.item_features import ItemFeatureStore
+
+
+def test_metadata_from_string_columns():
+    # ml-100k genres are split from the raw lines, so they are strings
+    items_metadata = pd.DataFrame(
+        [["1", "0", "1", "0"], ["0", "1", "0", "1"], ["2", "1", "1", "0"]],
+        columns=["item_id", "Action", "Comedy", "Drama"],
+    )
+    items_metadata["item_id"] = items_metadata["item_id"].astype(int)
+    items_metadata["metadata"] = items_metadata.iloc[:, 1:].values.tolist()
+
+    store = ItemFeatureStore.from_frames(items_metadata)
+
+    np.testing.assert_array_equal(
+        store.features["metadata"], [[1, 0, 1], [0, 1, 0], [1, 1, 0]]
+    )
+    assert store.features["metadata"].dtype == np.float32
+
+
+def test_metadata_without_feature_columns():
+    items_metadata = pd.DataFrame({"item_id": [0, 1], "metadata": ["[]", "[]"]})
+    with pytest.raises(ValueError):
+        ItemFeatureStore.from_frames(items_metadata)
+
+
+def test_metadata_with_non_numeric_columns():
+    items_metadata = pd.DataFrame({"item_id": [0, 1], "genre": ["Action", "Drama"]})
+    with pytest.raises(ValueError):
+        ItemFeatureStore.from_frames(items_metadata)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from src.model.replay_buffer import PriorityExperienceReplay
+
+
+def make_buffer(priorities):
+    buffer = PriorityExperienceReplay(len(priorities), 4, 3, "cpu")
+    buffer.tree.update_priorities(priorities, np.arange(len(priorities)))
+    buffer.is_full = True
+    return buffer
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 64])
+def test_sample_frequencies_match_priorities(batch_size):
+    # the stratified draws select each entry with probability priority / total,
+    # as the original one-draw-per-segment sampler did
+    np.random.seed(0)
+    priorities = np.array([1.0, 5.0, 0.5, 2.0, 8.0, 0.25, 3.0, 4.0, 0.75, 6.0])
+    buffer = make_buffer(priorities)
+
+    n_draws = 40000
+    counts = np.zeros(len(priorities))
+    for _ in range(n_draws // batch_size):
+        index_batch = buffer.sample(batch_size)[-1]
+        counts += np.bincount(index_batch, minlength=len(priorities))
+
+    frequencies = counts / counts.sum()
+    np.testing.assert_allclose(frequencies, priorities / priorities.sum(), atol=1e-2)
+
+
+def test_sample_weights():
+    np.random.seed(0)
+    priorities = np.array([1.0, 2.0, 4.0, 8.0])
+    buffer = make_buffer(priorities)
+    beta = buffer.beta
+
+    weights, index_batch = buffer.sample(32)[-2:]
+
+    p = priorities[index_batch] / priorities.sum()
+    max_weight = (len(priorities) * priorities.min() / priorities.sum()) ** -beta
+    np.testing.assert_allclose(
+        weights.numpy(), (p * len(priorities)) ** -beta / max_weight, rtol=1e-6
+    )
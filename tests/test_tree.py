@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+from src.model import tree as tree_module
+from src.model.tree import SegmentTree
+
+
+KERNELS = [False] + ([True] if tree_module.numba is not None else [])
+DTYPES = [np.float32, np.float64]
+# powers of two and not, down to a single leaf
+SIZES = [1, 2, 3, 5, 8, 100, 1000, 1023, 1025]
+
+
+def make_tree(size, n_filled, dtype, use_numba, rng, integer=True):
+    """Tree with `n_filled` leaves set, and the reference priorities."""
+
+    tree = SegmentTree(size, dtype=dtype, use_numba=use_numba)
+    if integer:
+        # integer priorities keep the float32 sums exact
+        priorities = rng.integers(1, 100, n_filled).astype(np.float64)
+    else:
+        priorities = rng.uniform(0.01, 1.0, n_filled)
+    tree.update_priorities(priorities, np.arange(n_filled))
+    return tree, priorities.astype(dtype)
+
+
+def reference_search(priorities, nums):
+    # first leaf whose cumulative priority reaches each value
+    return np.searchsorted(np.cumsum(priorities), nums, side="left")
+
+
+@pytest.mark.parametrize("use_numba", KERNELS)
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("size", SIZES)
+def test_sum_and_min(size, dtype, use_numba):
+    rng = np.random.default_rng(size)
+    for n_filled in {1, (size + 1) // 2, size}:
+        tree, priorities = make_tree(size, n_filled, dtype, use_numba, rng)
+        assert tree.sum_all_priority() == priorities.sum()
+        assert tree.min_priority() == priorities.min()
+
+
+@pytest.mark.parametrize("use_numba", KERNELS)
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("size", SIZES)
+def test_batch_search_matches_cumsum(size, dtype, use_numba):
+    rng = np.random.default_rng(size)
+    for n_filled in {1, (size + 1) // 2, size}:
+        tree, priorities = make_tree(size, n_filled, dtype, use_numba, rng)
+
+        # every value between two integer prefix sums
+        nums = np.arange(int(priorities.sum())) + 0.5
+        expected = reference_search(priorities, nums)
+
+        found, indices = tree.batch_search(nums)
+        np.testing.assert_array_equal(indices, expected)
+        np.testing.assert_array_equal(found, priorities[expected])
+
+        num = rng.choice(nums)
+        assert tree.search(num) == (
+            priorities[expected[nums == num][0]],
+            expected[nums == num][0],
+        )
+
+
+@pytest.mark.parametrize("use_numba", KERNELS)
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("size", SIZES)
+def test_batch_search_after_updates(size, dtype, use_numba):
+    rng = np.random.default_rng(size)
+    tree, priorities = make_tree(size, size, dtype, use_numba, rng)
+
+    # overwrite some leaves, with repeated indices (the last one wins)
+    indices = rng.integers(0, size, 2 * size)
+    new = rng.integers(1, 100, len(indices)).astype(dtype)
+    tree.update_priorities(new, indices)
+    for index, priority in zip(indices, new):
+        priorities[index] = priority
+
+    nums = np.arange(int(priorities.sum())) + 0.5
+    _, found = tree.batch_search(nums)
+    np.testing.assert_array_equal(found, reference_search(priorities, nums))
+    assert tree.min_priority() == priorities.min()
+
+
+@pytest.mark.parametrize("use_numba", KERNELS)
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_batch_search_never_returns_empty_leaves(dtype, use_numba):
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        size = int(rng.integers(2, 3000))
+        n_filled = int(rng.integers(1, size + 1))
+        tree, _ = make_tree(size, n_filled, dtype, use_numba, rng, integer=False)
+
+        total = tree.tree[1, 0]
+        nums = np.array(
+            [np.nextafter(total, dtype(0)), total, total * 2, -1.0, 0.0], dtype=dtype
+        )
+        priorities, indices = tree.batch_search(nums)
+        assert (priorities > 0).all()
+        assert ((indices >= 0) & (indices < n_filled)).all()
+
+
+@pytest.mark.parametrize("use_numba", KERNELS)
+def test_stratified_draws_stay_in_filled_leaves(use_numba):
+    # the last segment of a stratified draw can round to the total
+    rng = np.random.default_rng(1)
+    tree, _ = make_tree(1000, 700, np.float32, use_numba, rng, integer=False)
+    total = tree.sum_all_priority()
+    nums = (np.arange(4096) + rng.uniform(size=4096)) * (total / 4096)
+    nums[-1] = total
+
+    priorities, indices = tree.batch_search(nums)
+    assert (priorities > 0).all()
+    assert indices.max() < 700
+
+
+@pytest.mark.parametrize("use_numba", KERNELS)
+def test_update_with_no_indices(use_numba):
+    rng = np.random.default_rng(2)
+    tree, priorities = make_tree(100, 60, np.float64, use_numba, rng)
+    before = tree.tree.copy()
+
+    tree.update_priorities(np.array([]), np.array([], dtype=np.int64))
+    tree.update_priorities([], [])
+
+    np.testing.assert_array_equal(tree.tree, before)
+    assert tree.sum_all_priority() == priorities.sum()